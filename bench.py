@@ -0,0 +1,213 @@
+"""Benchmarks the grading pipeline end to end. Generates a synthetic course in a fresh database,
+queues every submission, runs main.py's queue loop against the fake engine (so matlab is not
+required) and writes throughput, latency, queries per job and peak memory to a json file so that
+regressions can be tracked over time. Run from the folder with conf/, for example:
+
+    python bench.py --submissions 500 --problems 20 --output bench.json -- --workers 4 --batch-verification
+
+Arguments after -- are passed on to main.py."""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+def _pad(contents: str, size: int) -> str:
+    """Pads matlab source with comments until it is at least size bytes"""
+    padding = size - len(contents) - 1
+    if padding <= 0:
+        return contents
+    line = '% ' + 'x' * 70 + '\n'
+    return contents + '\n' + (line * (padding // len(line) + 1))[:padding]
+
+def generate_course(assignments: int, problems: int, aux_files: int, submissions: int, file_size: int,
+                    script_time: float = 0.0, duplicate_fraction: float = 0.0, seed: int = 0) -> list:
+    """Creates an institution, a group and the given number of assignments, each with the given
+    number of problems (each with aux_files auxilary verification files) and submissions, with
+    every file padded to file_size bytes. Each submission and verification script takes
+    script_time seconds on the fake engine. A duplicate_fraction of the submissions copy an
+    earlier submission's files exactly.
+
+    Returns:
+        list[int]: the ids of the submissions, in a random order
+    """
+    from models import (DATABASE, Assignment, AssignmentProducedFile, Group, Institution, MatlabFile, Person, # pylint: disable=import-outside-toplevel
+                        Problem, ProblemAuxilaryVerificationFiles, Submission)
+    rng = random.Random(seed)
+    pause = f'pause({script_time}); ' if script_time > 0 else ''
+    submission_ids = []
+    with DATABASE.atomic():
+        institution = Institution.create(name='Benchmark University')
+        leader = Person.create(name='Benchmark Leader')
+        group = Group.create(institution=institution, name='BENCH 101', active=True)
+        students = [Person.create(name=f'Student {i}') for i in range(max(1, submissions // 4))]
+        now = datetime.datetime.now()
+        for assign_index in range(assignments):
+            assignment = Assignment.create(name=f'HW {assign_index}', group=group, creator=leader, created_at=now,
+                                           visible_at=now, late_at=now + datetime.timedelta(days=7), late_penalty=0.2,
+                                           closed_at=now + datetime.timedelta(days=14))
+            AssignmentProducedFile.create(assignment=assignment, filename='answer.mat')
+            for prob_index in range(problems):
+                verfile = MatlabFile.create(name=f'check{prob_index}.m', contents=_pad(
+                    f"{pause}points = {rng.randint(0, 5)};", file_size))
+                problem = Problem.create(assignment=assignment, points_out_of=5, verification_entry_file=verfile)
+                for aux_index in range(aux_files):
+                    auxfile = MatlabFile.create(name=f'helper{prob_index}_{aux_index}.m', contents=_pad(
+                        f'% helper {assign_index} {prob_index} {aux_index}', file_size))
+                    ProblemAuxilaryVerificationFiles.create(problem=problem, auxfile=auxfile)
+
+            originals = []
+            for subm_index in range(submissions):
+                if originals and rng.random() < duplicate_fraction:
+                    contents = rng.choice(originals)
+                else:
+                    contents = _pad(f"{pause}answer = {subm_index}; save('answer.mat')", file_size)
+                    originals.append(contents)
+                entry_file = MatlabFile.create(name='hw.m', contents=contents)
+                submission = Submission.create(assignment=assignment, submittor=rng.choice(students), submitted_at=now,
+                                               submission_entry_file=entry_file)
+                submission_ids.append(submission.id)
+    rng.shuffle(submission_ids)
+    return submission_ids
+
+def percentile(values, fraction: float) -> float:
+    """Gets the value at the given fraction (such as 0.99) of the sorted values by nearest rank,
+    or None if there are no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+class _QueryCounter:
+    """Counts the statements executed through a peewee database while installed"""
+    def __init__(self, database):
+        self.database = database
+        self.count = 0
+        self._lock = threading.Lock()
+        self._original = database.execute_sql
+
+    def _execute_sql(self, *args, **kwargs):
+        with self._lock:
+            self.count += 1
+        return self._original(*args, **kwargs)
+
+    def __enter__(self):
+        self.database.execute_sql = self._execute_sql
+        return self
+
+    def __exit__(self, *args):
+        self.database.execute_sql = self._original
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _report_totals(submission_ids) -> list:
+    """Gets the 'total' timing from the report of each of the given submissions"""
+    from models import SubmissionReport # pylint: disable=import-outside-toplevel
+    totals = []
+    for chunk_start in range(0, len(submission_ids), 500):
+        chunk = submission_ids[chunk_start:chunk_start + 500]
+        for stored in SubmissionReport.select().where(SubmissionReport.submission.in_(chunk)):
+            match = re.search(r'^total: ([0-9.]+)s$', stored.text, re.MULTILINE)
+            if match:
+                totals.append(float(match.group(1)))
+    return totals
+
+def main():
+    """Entry point"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--assignments', action='store', type=int, help='The number of assignments to generate', default=2)
+    parser.add_argument('--problems', action='store', type=int, help='The number of problems per assignment', default=5)
+    parser.add_argument('--aux-files', action='store', type=int, help='The number of auxilary verification files per problem', default=1)
+    parser.add_argument('--submissions', action='store', type=int, help='The number of submissions per assignment', default=50)
+    parser.add_argument('--file-size', action='store', type=int, help='The size in bytes every generated file is padded to', default=2048)
+    parser.add_argument('--script-time', action='store', type=float, help='The seconds every submission and verification script takes on the fake engine', default=0.0)
+    parser.add_argument('--duplicate-fraction', action='store', type=float, help='The fraction of submissions whose files are identical to an earlier submission', default=0.0)
+    parser.add_argument('--seed', action='store', type=int, help='The seed for generating the course', default=0)
+    parser.add_argument('--output', action='store', help='The json file the results are written to', default='bench.json')
+    parser.add_argument('--keep', action='store_true', help='If set then the database and queues are kept and their folder printed')
+    parser.add_argument('main_args', nargs='*', help='Arguments passed on to main.py after --, such as --workers 4')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='matlab-evaluator-bench-')
+    os.environ['MATLAB_EVALUATOR_DATABASE'] = os.path.join(folder, 'bench.db')
+    import main as evaluator # pylint: disable=import-outside-toplevel
+    from jobqueue import BatchAckQueue # pylint: disable=import-outside-toplevel
+    from models import DATABASE # pylint: disable=import-outside-toplevel
+
+    try:
+        starttime = time.perf_counter()
+        submission_ids = generate_course(args.assignments, args.problems, args.aux_files, args.submissions,
+                                         args.file_size, args.script_time, args.duplicate_fraction, args.seed)
+        generate_time = time.perf_counter() - starttime
+
+        logging_conf = os.path.join(folder, 'logging.json')
+        with open(logging_conf, 'w') as outfile:
+            json.dump({'version': 1, 'disable_existing_loggers': False, 'root': {'level': 'WARNING'}}, outfile)
+        in_folder = os.path.join(folder, 'in')
+        out_folder = os.path.join(folder, 'out')
+        enqueued_at = time.time()
+        BatchAckQueue(in_folder).put_batch(submission_ids)
+        main_args = ['--input-database', in_folder, '--output-database', out_folder, '--engine', 'fake',
+                     '--logging-conf', logging_conf] + args.main_args
+
+        with _QueryCounter(DATABASE) as queries:
+            starttime = time.perf_counter()
+            evaluator.main(main_args)
+            elapsed = time.perf_counter() - starttime
+
+        # every job was queued at once, so latency is from then until its result was queued
+        finished = BatchAckQueue(out_folder).get_batch(len(submission_ids) + 1, timeout=0)
+        latencies = [item['timestamp'] - enqueued_at for item in finished]
+        grade_times = _report_totals(submission_ids)
+
+        results = {
+            'created_at': datetime.datetime.now().isoformat(),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'course': {key: getattr(args, key) for key in ('assignments', 'problems', 'aux_files', 'submissions',
+                                                            'file_size', 'script_time', 'duplicate_fraction', 'seed')},
+            'main_args': args.main_args,
+            'generate_seconds': generate_time,
+            'jobs': len(submission_ids),
+            'jobs_finished': len(finished),
+            'elapsed_seconds': elapsed,
+            'throughput_jobs_per_second': len(finished) / elapsed if elapsed > 0 else None,
+            'latency_p50_seconds': percentile(latencies, 0.5),
+            'latency_p99_seconds': percentile(latencies, 0.99),
+            'grade_p50_seconds': percentile(grade_times, 0.5),
+            'grade_p99_seconds': percentile(grade_times, 0.99),
+            'queries_per_job': queries.count / len(submission_ids) if submission_ids else None,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }
+    finally:
+        if args.keep:
+            print(f'Kept benchmark files in {folder}', file=sys.stderr)
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    for key, value in itertools.islice(results.items(), 7, None):
+        print(f'{key}: {value:.4g}' if isinstance(value, float) else f'{key}: {value}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+"""Where graders get jobs from and report results to. A SQLiteBroker uses queue folders on the
+local machine, which only processes on that machine can share. To grade on several machines, run
+this module as a server next to the queue folders:
+
+    python broker.py --input-database in --output-database out --port 7070
+
+and start main.py on each grading machine with --broker SERVER:7070. Jobs handed to a worker are
+leased to it for --lease-time seconds and the worker renews the leases while it holds them, so if
+a worker dies or loses its connection its jobs go back to the queue and are handed to another. Jobs
+can be queued from anywhere with TCPBroker.put_batch or locally by putting them in the input folder
+as before."""
+
+import argparse
+import json
+import logging
+import logging.config
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+from jobqueue import BatchAckQueue
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+LEASES = metrics.Gauge('matlab_evaluator_broker_leases', 'Jobs handed to workers which have not been acked or nacked yet')
+EXPIRED_LEASES = metrics.Counter('matlab_evaluator_broker_expired_leases', 'Jobs returned to the queue because their worker stopped renewing them')
+
+DEFAULT_LEASE_TIME = 60.0
+"""The default number of seconds a job is leased to a worker before it is handed to another
+unless the worker renews it"""
+
+MAX_WAIT = 30.0
+"""The most seconds the server waits for jobs in a single request. Workers waiting longer ask again"""
+
+NETWORK_TIMEOUT = 30.0
+"""The seconds a worker waits for the server to answer, on top of any time the server is asked to wait"""
+
+class BrokerError(Exception):
+    """The broker could not be reached or rejected a request"""
+
+class Broker:
+    """Hands out jobs and takes back their results. Jobs are raw queue items: dicts with 'pqid',
+    'data' and 'timestamp' (when the job was queued). A job must be acked or nacked once done
+    with, otherwise it is eventually handed out again."""
+
+    def get_batch(self, size: int, timeout: float = None) -> list:
+        """Gets up to size jobs, waiting up to timeout seconds for at least one to be available
+        (forever if timeout is None)
+
+        Returns:
+            the jobs which were fetched. Empty if the timeout passed without any becoming available
+        """
+        raise NotImplementedError
+
+    def ack_batch(self, pqids, results=()):
+        """Marks the jobs with the given pqids as done and reports the given results"""
+        raise NotImplementedError
+
+    def nack_batch(self, pqids):
+        """Returns the jobs with the given pqids to the queue to be handed out again"""
+        raise NotImplementedError
+
+    def put_batch(self, items):
+        """Queues the given jobs"""
+        raise NotImplementedError
+
+    def depths(self) -> dict:
+        """Gets the number of items waiting in each queue, by queue name ('in' and 'out' if
+        results are kept)"""
+        raise NotImplementedError
+
+    def close(self):
+        """Releases any connections. Jobs which are still held are handed out again once their
+        leases expire"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SQLiteBroker(Broker):
+    """Jobs and results in queue folders on this machine. Jobs left unacked by a process which
+    died are handed out again when the input folder is next opened
+
+    Attributes:
+        jobque (BatchAckQueue): the queue jobs are read from
+        outque (BatchAckQueue): the queue results are put in or None to discard them
+    """
+    def __init__(self, input_database: str, output_database: str = None, **kwargs):
+        self.jobque = BatchAckQueue(input_database, **kwargs)
+        self.outque = None if output_database is None else BatchAckQueue(output_database, **kwargs)
+
+    def get_batch(self, size: int, timeout: float = None) -> list:
+        return self.jobque.get_batch(size, timeout=timeout)
+
+    def ack_batch(self, pqids, results=()):
+        self.jobque.ack_batch(pqids)
+        if self.outque is not None and results:
+            self.outque.put_batch(results)
+
+    def nack_batch(self, pqids):
+        self.jobque.nack_batch(pqids)
+
+    def put_batch(self, items):
+        self.jobque.put_batch(items)
+
+    def depths(self) -> dict:
+        result = {'in': self.jobque.waiting_count()}
+        if self.outque is not None:
+            result['out'] = self.outque.waiting_count()
+        return result
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Answers requests from one worker connection. Each request and response is one line of json"""
+    def handle(self):
+        try:
+            for line in self.rfile:
+                try:
+                    response = self.server.respond(json.loads(line))
+                except Exception as exc: # pylint: disable=broad-except
+                    LOG.warning('Failed to answer request from %s', self.client_address, exc_info=1)
+                    response = {'error': f'{type(exc).__name__}: {exc}'}
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        except ConnectionError:
+            # workers which are killed reset their connection; their leases expire as usual
+            LOG.debug('Lost connection to %s', self.client_address)
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    """Serves the jobs in a SQLiteBroker to TCPBrokers over the network and leases each job to the
+    worker it was handed to. Leases which are not renewed within lease_time seconds expire and
+    their jobs go back to the queue. Acks and nacks for jobs whose lease has expired are ignored,
+    since the job may already have been handed to another worker.
+
+    Attributes:
+        broker (SQLiteBroker): the queues jobs are served from and results put in
+        lease_time (float): the seconds a job is leased for
+        leases (dict[int, tuple[str, float]]): the worker holding each leased job by pqid, and
+            the time.monotonic() the lease expires at
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, broker: SQLiteBroker, lease_time: float = DEFAULT_LEASE_TIME):
+        super().__init__(address, _Handler)
+        self.broker = broker
+        self.lease_time = lease_time
+        self.leases = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._background = []
+
+    def start(self):
+        """Starts serving and expiring leases from background threads. Call shutdown() to stop"""
+        for target, name in ((self.serve_forever, 'broker'), (self._expire_loop, 'broker-leases')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._background.append(thread)
+        LOG.info('Serving jobs on %s:%s', *self.server_address[:2])
+
+    def shutdown(self):
+        self._stopped.set()
+        super().shutdown()
+        for thread in self._background:
+            thread.join()
+        self.server_close()
+
+    def _expire_loop(self):
+        while not self._stopped.wait(min(self.lease_time / 4, 1.0)):
+            self.expire()
+
+    def expire(self) -> list:
+        """Returns the jobs whose leases have expired to the queue
+
+        Returns:
+            list[int]: the pqids of the jobs returned
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [pqid for pqid, (_, expires_at) in self.leases.items() if expires_at <= now]
+            if not expired:
+                return []
+            workers = {self.leases.pop(pqid)[0] for pqid in expired}
+            self.broker.nack_batch(expired)
+            LEASES.set(len(self.leases))
+        EXPIRED_LEASES.inc(len(expired))
+        LOG.warning('Leases of %s jobs held by %s expired - returned them to the queue', len(expired), ', '.join(sorted(workers)))
+        return expired
+
+    def _release(self, worker: str, pqids) -> tuple:
+        """Removes the leases the given worker holds on the given jobs. Must hold the lock
+
+        Returns:
+            (the pqids which were leased to the worker, the pqids which were not)
+        """
+        held, lost = [], []
+        for pqid in pqids:
+            lease = self.leases.get(pqid)
+            if lease is not None and lease[0] == worker:
+                del self.leases[pqid]
+                held.append(pqid)
+            else:
+                lost.append(pqid)
+        LEASES.set(len(self.leases))
+        return held, lost
+
+    def respond(self, request: dict) -> dict:
+        """Carries out the given request from a worker and gets the response"""
+        operation = request.get('op')
+        worker = str(request.get('worker'))
+        if operation == 'get':
+            timeout = request.get('timeout')
+            timeout = MAX_WAIT if timeout is None else min(float(timeout), MAX_WAIT)
+            items = self.broker.get_batch(int(request['size']), timeout=timeout)
+            with self._lock:
+                expires_at = time.monotonic() + self.lease_time
+                for item in items:
+                    self.leases[item['pqid']] = (worker, expires_at)
+                LEASES.set(len(self.leases))
+            return {'items': items, 'lease_time': self.lease_time}
+        if operation == 'renew':
+            expires_at = time.monotonic() + self.lease_time
+            lost = []
+            with self._lock:
+                for pqid in request['pqids']:
+                    lease = self.leases.get(pqid)
+                    if lease is not None and lease[0] == worker:
+                        self.leases[pqid] = (worker, expires_at)
+                    else:
+                        lost.append(pqid)
+            return {'lost': lost}
+        if operation == 'ack':
+            with self._lock:
+                held, lost = self._release(worker, request['pqids'])
+                kept = set(held)
+                results = [result for pqid, result in zip(request['pqids'], request.get('results', [])) if pqid in kept]
+                self.broker.ack_batch(held, results)
+            return {'lost': lost}
+        if operation == 'nack':
+            with self._lock:
+                held, lost = self._release(worker, request['pqids'])
+                self.broker.nack_batch(held)
+            return {'lost': lost}
+        if operation == 'put':
+            self.broker.put_batch(request['items'])
+            return {}
+        if operation == 'depths':
+            return {'depths': self.broker.depths()}
+        raise ValueError(f'unknown operation {operation!r}')
+
+class _Connection:
+    """A connection to a BrokerServer which reconnects once if a request fails"""
+    def __init__(self, address: tuple):
+        self.address = address
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=NETWORK_TIMEOUT)
+        self._file = self._sock.makefile('rwb')
+
+    def close(self):
+        """Closes the connection if it is open"""
+        if self._sock is not None:
+            try:
+                self._file.close()
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = self._file = None
+
+    def request(self, request: dict, wait: float = 0) -> dict:
+        """Sends the given request and gets the response, allowing wait seconds more than usual
+        for the server to answer"""
+        data = json.dumps(request).encode('utf-8') + b'\n'
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._sock.settimeout(NETWORK_TIMEOUT + wait)
+                    self._file.write(data)
+                    self._file.flush()
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError('connection closed by broker')
+                    break
+                except OSError as exc:
+                    self.close()
+                    if attempt > 0:
+                        raise BrokerError(f'cannot reach broker at {self.address[0]}:{self.address[1]}: {exc}') from exc
+                    LOG.warning('Lost connection to broker at %s:%s - reconnecting', *self.address, exc_info=1)
+        response = json.loads(line)
+        if 'error' in response:
+            raise BrokerError(f'broker rejected {request["op"]}: {response["error"]}')
+        return response
+
+def parse_address(address: str) -> tuple:
+    """Gets the (host, port) of an address like 'localhost:7070'"""
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f'expected a broker address like HOST:PORT but got {address}')
+    return host, int(port)
+
+class TCPBroker(Broker):
+    """Jobs and results served by a BrokerServer. The leases on jobs which have been fetched but
+    not acked or nacked are renewed from a background thread, started once the first fetch tells it
+    the lease time, until they are
+
+    Attributes:
+        address (tuple[str, int]): the host and port of the server
+        worker (str): identifies this broker to the server; unique to this instance
+        held (set[int]): the pqids of the jobs which have been fetched and not acked or nacked
+    """
+    def __init__(self, address: str):
+        self.address = parse_address(address)
+        self.worker = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.held = set()
+        self._lease_time = DEFAULT_LEASE_TIME
+        self._lock = threading.Lock()
+        self._connection = _Connection(self.address)
+        self._renewer = _Connection(self.address)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _request(self, operation: str, wait: float = 0, **fields) -> dict:
+        return self._connection.request({'op': operation, 'worker': self.worker, **fields}, wait)
+
+    def _renew_loop(self):
+        while not self._stopped.wait(self._lease_time / 3):
+            with self._lock:
+                pqids = list(self.held)
+            if not pqids:
+                continue
+            try:
+                lost = self._renewer.request({'op': 'renew', 'worker': self.worker, 'pqids': pqids})['lost']
+            except BrokerError:
+                LOG.warning('Failed to renew the leases of %s jobs', len(pqids), exc_info=1)
+                continue
+            self._forget(lost, 'renew')
+
+    def _forget(self, lost, operation: str):
+        with self._lock:
+            self.held.difference_update(lost)
+        if lost:
+            LOG.warning('Could not %s %s jobs since their leases expired: %s', operation, len(lost), lost)
+
+    def get_batch(self, size: int, timeout: float = None) -> list:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = MAX_WAIT if deadline is None else min(max(deadline - time.monotonic(), 0), MAX_WAIT)
+            response = self._request('get', wait, size=size, timeout=wait)
+            self._lease_time = response['lease_time']
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._renew_loop, name='broker-renew', daemon=True)
+                self._thread.start()
+            items = response['items']
+            if items or (deadline is not None and time.monotonic() >= deadline):
+                with self._lock:
+                    self.held.update(item['pqid'] for item in items)
+                return items
+
+    def ack_batch(self, pqids, results=()):
+        pqids = list(pqids)
+        if pqids:
+            self._forget(self._request('ack', pqids=pqids, results=list(results))['lost'], 'ack')
+            with self._lock:
+                self.held.difference_update(pqids)
+
+    def nack_batch(self, pqids):
+        pqids = list(pqids)
+        if pqids:
+            self._forget(self._request('nack', pqids=pqids)['lost'], 'nack')
+            with self._lock:
+                self.held.difference_update(pqids)
+
+    def put_batch(self, items):
+        items = list(items)
+        if items:
+            self._request('put', items=items)
+
+    def depths(self) -> dict:
+        return self._request('depths')['depths']
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._connection.close()
+        self._renewer.close()
+
+def main():
+    """Entry point for the server"""
+    parser = argparse.ArgumentParser(description='Serves jobs to graders on other machines')
+    parser.add_argument('--input-database', action='store', help='The path to the folder which jobs are pushed to', default='in')
+    parser.add_argument('--output-database', action='store', help='The path to the folder which evaluations are pushed to', default='out')
+    parser.add_argument('--no-output', action='store_true', help='If set then evaluations are not pushed to the output database')
+    parser.add_argument('--host', action='store', help='The address to listen on; 0.0.0.0 for every interface', default='127.0.0.1')
+    parser.add_argument('--port', action='store', type=int, help='The port to listen on', default=7070)
+    parser.add_argument('--lease-time', action='store', type=float, help='The seconds a job is held for a worker which stops responding before it is handed to another', default=DEFAULT_LEASE_TIME)
+    parser.add_argument('--logging-conf', action='store', help='The path to the json file that configures logging', default='conf/logging.json')
+    parser.add_argument('--metrics-port', action='store', type=int, help='If set then metrics are served on this port at /metrics', default=None)
+    args = parser.parse_args()
+
+    with open(args.logging_conf, 'r') as infile:
+        logging.config.dictConfig(json.load(infile))
+
+    broker = SQLiteBroker(args.input_database, None if args.no_output else args.output_database, multithreading=True)
+    server = BrokerServer((args.host, args.port), broker, args.lease_time)
+    metrics_server = None if args.metrics_port is None else metrics.serve(args.metrics_port)
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,535 @@
+"""Describes the engines that grading can run matlab scripts with. The grader only talks to
+engines through the Engine interface so that it does not need to care whether it is talking
+to a real matlab engine or a stand-in"""
+
+import io
+import logging
+import math
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+class BatchResult:
+    """The outcome of one of the scripts run by Engine.run_batch
+
+    Attributes:
+        value (any): the value of the requested variable after the script ran, or None if the
+            script did not set it or failed
+        output (str): everything the script displayed
+        error (str): the message of the error the script raised, or None if it succeeded
+        elapsed (float): the number of seconds the script took
+    """
+    def __init__(self, value, output: str, error: str, elapsed: float):
+        self.value = value
+        self.output = output
+        self.error = error
+        self.elapsed = elapsed
+
+class Engine:
+    """The interface for something which can evaluate matlab scripts. Engines are not thread
+    safe; each engine should only be used by one grader at a time.
+
+    Attributes:
+        workdir (str): a folder which belongs to this engine alone. Grading creates its temporary
+            folders in here. May be None to use the default temporary folder
+    """
+    def __init__(self, workdir: str = None):
+        self.workdir = workdir
+
+    def start(self) -> float:
+        """Starts this engine if it has not been started already. Engines start themselves when
+        first used, so this only needs to be called to control when the startup cost is paid.
+
+        Returns:
+            the number of seconds spent starting the engine
+        """
+        return 0.0
+
+    def cd(self, path: str) -> str:
+        """Changes the current folder of the engine to the given path and returns the previous
+        current folder. cd('.') just returns the current folder"""
+        raise NotImplementedError
+
+    def run(self, name: str, stdout, stderr):
+        """Starts running the script with the given name (without the '.m') in the current folder
+        in the background, writing its output to the given streams.
+
+        Returns:
+            a future supporting done(), wait(timeout), cancel(), cancelled() and result(). wait
+            blocks until the script finishes or is cancelled and returns True, or returns False
+            if the timeout passes first
+        """
+        raise NotImplementedError
+
+    def run_batch(self, names, variable: str, stdout, stderr):
+        """Starts running each of the scripts with the given names in the current folder in the
+        background, one after another in a single call. Each script runs in its own function
+        scope that starts with a copy of the workspace, so scripts cannot see each other's
+        variables and the workspace is left unchanged. A script which fails does not stop the
+        rest.
+
+        Returns:
+            a future as for run, whose result() is a list with a BatchResult for each script,
+            holding the value of the given variable once that script finished
+        """
+        raise NotImplementedError
+
+    def get_variable(self, name: str):
+        """Gets the value of the variable with the given name in the workspace"""
+        raise NotImplementedError
+
+    def clear_workspace(self):
+        """Removes every variable from the workspace"""
+        raise NotImplementedError
+
+    def save_workspace(self, path: str):
+        """Saves every variable in the workspace to the file at the given path"""
+        raise NotImplementedError
+
+    def load_workspace(self, path: str):
+        """Loads the variables saved with save_workspace into the workspace, replacing variables
+        with the same names and leaving the rest"""
+        raise NotImplementedError
+
+    def memory_usage(self) -> int:
+        """Gets the number of bytes of memory the engine is using, or None if unknown"""
+        return None
+
+    def restart(self):
+        """Replaces the underlying engine with a fresh one, losing the workspace"""
+        self.quit()
+        self.start()
+
+    def quit(self):
+        """Stops this engine. It is started again if it is used afterward"""
+        raise NotImplementedError
+
+def _matlab_str(value: str) -> str:
+    """Gets the matlab literal for the given string"""
+    return "'" + value.replace("'", "''") + "'"
+
+_BATCH_FUNCTION = 'matlab_evaluator_batch'
+
+_BATCH_SOURCE = """function results = matlab_evaluator_batch(names, variable)
+%MATLAB_EVALUATOR_BATCH Runs each of the named scripts in its own function scope, starting from a
+%copy of the base workspace. Returns a cell array with a struct per script holding the value of the
+%named variable (NaN if unset), what the script displayed, its error message and how long it took
+names = cellstr(names);
+snapshot = struct();
+base_vars = evalin('base', 'who');
+for k = 1:numel(base_vars)
+    snapshot.(base_vars{k}) = evalin('base', base_vars{k});
+end
+results = cell(1, numel(names));
+for k = 1:numel(names)
+    started = tic;
+    [value, output, message] = run_one(names{k}, variable, snapshot);
+    results{k} = struct('value', value, 'output', output, 'error', message, 'elapsed', toc(started));
+end
+end
+
+function [value, output, message] = run_one(name, variable, snapshot)
+value = NaN;
+output = '';
+message = '';
+try
+    [output, workspace] = run_script(name, snapshot);
+    if isfield(workspace, variable)
+        value = double(workspace.(variable));
+    end
+catch exception
+    message = exception.message;
+end
+end
+
+function [matlab_evaluator_output, matlab_evaluator_workspace] = run_script(...
+    matlab_evaluator_name, matlab_evaluator_snapshot)
+%RUN_SCRIPT Runs the named script in a workspace holding nothing but the snapshot, so that a script
+%which clears its workspace cannot clear anything run_one needs, and returns every variable it left
+matlab_evaluator_fields = fieldnames(matlab_evaluator_snapshot);
+for matlab_evaluator_k = 1:numel(matlab_evaluator_fields)
+    eval([matlab_evaluator_fields{matlab_evaluator_k} ' = matlab_evaluator_snapshot.' ...
+          matlab_evaluator_fields{matlab_evaluator_k} ';']);
+end
+clear matlab_evaluator_fields matlab_evaluator_k matlab_evaluator_snapshot
+matlab_evaluator_output = evalc(matlab_evaluator_name);
+matlab_evaluator_workspace = struct();
+matlab_evaluator_fields = who;
+for matlab_evaluator_k = 1:numel(matlab_evaluator_fields)
+    matlab_evaluator_workspace.(matlab_evaluator_fields{matlab_evaluator_k}) = ...
+        eval(matlab_evaluator_fields{matlab_evaluator_k});
+end
+end
+"""
+"""The matlab function which MatlabEngine.run_batch calls, written to a folder on the matlab path"""
+
+def _batch_value(value):
+    try:
+        value = float(value)
+    except TypeError:
+        return value
+    return None if math.isnan(value) else value
+
+def _batch_results(results) -> list:
+    """Converts what the batch function returns into a list of BatchResult"""
+    return [BatchResult(_batch_value(result['value']), result['output'], result['error'] or None,
+                        float(result['elapsed']))
+            for result in results]
+
+class _MatlabFuture:
+    """Wraps a matlab.engine.FutureResult so that it can be waited on without fetching the result.
+    If convert is not None, result() returns convert applied to the result of the call"""
+    def __init__(self, future, timeout_error, convert=None):
+        self.future = future
+        self.timeout_error = timeout_error
+        self.convert = convert
+        self._finished = False
+        self._error = None
+        self._value = None
+
+    def done(self) -> bool:
+        return self._finished or self.future.done()
+
+    def wait(self, timeout: float = None) -> bool:
+        if self._finished:
+            return True
+        try:
+            self._value = self.future.result(timeout)
+        except self.timeout_error:
+            return False
+        except Exception as exc: # pylint: disable=broad-except
+            self._error = exc
+        self._finished = True
+        return True
+
+    def cancel(self) -> bool:
+        return self.future.cancel()
+
+    def cancelled(self) -> bool:
+        return self.future.cancelled()
+
+    def result(self, timeout: float = None):
+        if not self.wait(timeout):
+            raise self.timeout_error('timed out waiting for matlab')
+        if self._error is not None:
+            raise self._error
+        return self._value if self.convert is None else self.convert(self._value)
+
+class MatlabEngine(Engine):
+    """An engine backed by a real matlab process. Matlab is not started until the engine is
+    first used or start() is called
+
+    Attributes:
+        engine (matlab.engine.MatlabEngine): the underlying matlab engine or None if not started
+        startup_time (float): the number of seconds it took to start matlab or None if not started
+    """
+    def __init__(self, workdir: str = None):
+        super().__init__(workdir)
+        self.engine = None
+        self.startup_time = None
+        self._start_lock = threading.Lock()
+        self._timeout_error = None
+        self._batch_dir = None
+
+    def start(self) -> float:
+        with self._start_lock:
+            if self.engine is None:
+                import matlab.engine # pylint: disable=import-outside-toplevel
+                starttime = time.time()
+                self.engine = matlab.engine.start_matlab()
+                self._timeout_error = matlab.engine.TimeoutError
+                self.startup_time = time.time() - starttime
+                LOG.info('Started matlab in %.1fs', self.startup_time)
+        return self.startup_time
+
+    def _matlab(self):
+        if self.engine is None:
+            self.start()
+        return self.engine
+
+    def cd(self, path: str) -> str:
+        return self._matlab().cd(path)
+
+    def run(self, name: str, stdout, stderr):
+        target = getattr(self._matlab(), name)
+        return _MatlabFuture(target(nargout=0, stdout=stdout, stderr=stderr, background=True), self._timeout_error)
+
+    def run_batch(self, names, variable: str, stdout, stderr):
+        engine = self._matlab()
+        if self._batch_dir is None:
+            self._batch_dir = tempfile.mkdtemp(prefix='matlab-evaluator-batch-')
+            with open(os.path.join(self._batch_dir, _BATCH_FUNCTION + '.m'), 'w') as outfile:
+                outfile.write(_BATCH_SOURCE)
+            engine.addpath(self._batch_dir, nargout=0)
+        target = getattr(engine, _BATCH_FUNCTION)
+        future = target(list(names), variable, nargout=1, stdout=stdout, stderr=stderr, background=True)
+        return _MatlabFuture(future, self._timeout_error, _batch_results)
+
+    def get_variable(self, name: str):
+        return self._matlab().workspace[name]
+
+    def clear_workspace(self):
+        self._matlab().eval('clear', nargout=0)
+
+    def save_workspace(self, path: str):
+        self._matlab().eval(f'save({_matlab_str(path)})', nargout=0)
+
+    def load_workspace(self, path: str):
+        self._matlab().eval(f'load({_matlab_str(path)})', nargout=0)
+
+    def quit(self):
+        if self.engine is not None:
+            self.engine.quit()
+            self.engine = None
+        if self._batch_dir is not None:
+            shutil.rmtree(self._batch_dir, ignore_errors=True)
+            self._batch_dir = None
+
+class FakeExecutionError(Exception):
+    """Raised from the result of a fake script which errors, like matlab.engine.MatlabExecutionError"""
+
+class FakeScript:
+    """Describes how a FakeEngine behaves when asked to run a particular script
+
+    Attributes:
+        duration (float): the number of seconds the script takes to run
+        stdout (str): what the script writes to stdout
+        stderr (str): what the script writes to stderr
+        variables (dict[str, any]): the variables the script sets in the workspace
+        files (dict[str, str]): the files the script creates in the current folder, by name
+        error (str): if not None, the script fails with this message after running
+        hang (bool): if True the script never finishes unless cancelled
+        ignore_cancel (bool): if True cancelling the script does nothing, like a stuck MEX call
+        leak (int): the number of bytes of memory the script allocates and never frees
+        clears (bool): if True the script clears the workspace before setting its variables
+    """
+    def __init__(self, duration: float = 0, stdout: str = '', stderr: str = '', variables: dict = None,
+                 files: dict = None, error: str = None, hang: bool = False, ignore_cancel: bool = False,
+                 leak: int = 0, clears: bool = False):
+        self.duration = duration
+        self.stdout = stdout
+        self.stderr = stderr
+        self.variables = variables or {}
+        self.files = files or {}
+        self.error = error
+        self.hang = hang
+        self.ignore_cancel = ignore_cancel
+        self.leak = leak
+        self.clears = clears
+
+    @classmethod
+    def parse(cls, contents: str) -> 'FakeScript':
+        """Describes the behavior of the given matlab source. Only a tiny subset of matlab is
+        understood, one statement per line or semicolon, and everything else is ignored:
+
+            points = 5          sets the variable to the number
+            disp('text')        writes the text to stdout
+            pause(0.5)          takes an extra half a second
+            save('out.mat')     creates the file out.mat
+            error('message')    fails with the given message
+            clear               clears the workspace, as do clear all and clearvars
+        """
+        script = cls()
+        stdout = []
+        for statement in re.split(r'[;\n]', contents):
+            statement = statement.strip()
+            if re.fullmatch(r'clear(\s+all)?|clearvars', statement):
+                script.clears = True
+                script.variables = {}
+                continue
+            match = re.fullmatch(r'(\w+)\s*=\s*([-+0-9.eE]+)', statement)
+            if match:
+                script.variables[match.group(1)] = float(match.group(2))
+                continue
+            match = re.fullmatch(r"(disp|pause|save|error)\s*\(\s*('(?:[^']|'')*'|[-+0-9.eE]+)\s*\)", statement)
+            if not match:
+                continue
+            func, arg = match.groups()
+            value = arg[1:-1].replace("''", "'") if arg.startswith("'") else float(arg)
+            if func == 'disp':
+                stdout.append(f'{value}\n')
+            elif func == 'pause':
+                script.duration += float(value)
+            elif func == 'save':
+                script.files[str(value)] = ''
+            elif script.error is None:
+                script.error = str(value)
+        script.stdout = ''.join(stdout)
+        return script
+
+class FakeFuture:
+    """The result of running a script on a FakeEngine, which acts like matlab.engine.FutureResult.
+    Calls complete() once the given duration has passed, unless cancelled first or duration is None
+
+    Attributes:
+        complete (callable): applies the effects of the script, returning its error message or None
+        ignore_cancel (bool): if True cancel() does nothing
+        value (any): what result() returns once the script has finished
+    """
+    def __init__(self, complete, duration: float = None, ignore_cancel: bool = False, value=None):
+        self.complete = complete
+        self.ignore_cancel = ignore_cancel
+        self.value = value
+        self._finished = threading.Event()
+        self._cancelled = False
+        self._error = None
+        self._timer = None
+        self._lock = threading.Lock()
+        if duration is not None and duration <= 0:
+            self._finish()
+        elif duration is not None:
+            self._timer = threading.Timer(duration, self._finish)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _finish(self):
+        with self._lock:
+            if self._finished.is_set():
+                return
+            self._error = self.complete()
+            self._finished.set()
+
+    def done(self) -> bool:
+        """Returns True if the script finished or was cancelled"""
+        return self._finished.is_set()
+
+    def cancel(self) -> bool:
+        """Cancels the script if it has not finished yet, returning True if it was cancelled"""
+        with self._lock:
+            if self._finished.is_set() or self.ignore_cancel:
+                return self._cancelled
+            if self._timer is not None:
+                self._timer.cancel()
+            self._cancelled = True
+            self._finished.set()
+            return True
+
+    def cancelled(self) -> bool:
+        """Returns True if the script was cancelled"""
+        return self._cancelled
+
+    def wait(self, timeout: float = None) -> bool:
+        """Waits for the script to finish or be cancelled, returning False if the timeout passed first"""
+        return self._finished.wait(timeout)
+
+    def result(self, timeout: float = None):
+        """Waits for the script to finish, raising its error if it had one"""
+        if not self._finished.wait(timeout):
+            raise TimeoutError('timed out waiting for fake script')
+        if self._cancelled:
+            raise FakeExecutionError('script was cancelled')
+        if self._error is not None:
+            raise FakeExecutionError(self._error)
+        return self.value
+
+class FakeEngine(Engine):
+    """An in-process stand-in for matlab which never actually evaluates matlab. When asked to run
+    a script it looks up its behavior from the scripts it was given, first by the contents of the
+    file and then by the name of the script. Scripts which are not known are parsed with
+    FakeScript.parse, so simple files such as "disp('hi'); points = 5;" behave as expected.
+
+    Attributes:
+        scripts (dict[str, FakeScript]): the behavior of scripts by file contents or name
+        workspace (dict[str, any]): the variables in the workspace
+        cwd (str): the current folder
+        ran (list[str]): the name of every script this engine has started, in order
+        leaked (list[bytearray]): the memory leaked by scripts, freed when the engine quits
+    """
+    def __init__(self, workdir: str = None, scripts: dict = None):
+        super().__init__(workdir)
+        self.scripts = scripts or {}
+        self.workspace = {}
+        self.cwd = os.getcwd()
+        self.ran = []
+        self.leaked = []
+        self._parsed = {}
+
+    def cd(self, path: str) -> str:
+        oldpath = self.cwd
+        self.cwd = os.path.normpath(os.path.join(self.cwd, path))
+        return oldpath
+
+    def _script_for(self, name: str) -> FakeScript:
+        path = os.path.join(self.cwd, name + '.m')
+        if not os.path.exists(path):
+            return FakeScript(error=f"Undefined function or variable '{name}'.")
+        with open(path, 'r') as infile:
+            contents = infile.read()
+        script = self.scripts.get(contents, self.scripts.get(name))
+        if script is None:
+            script = self._parsed.get(contents)
+            if script is None:
+                script = FakeScript.parse(contents)
+                self._parsed[contents] = script
+        return script
+
+    def _complete(self, script, cwd, stdout, stderr, workspace):
+        """Applies the effects of the given script, returning its error message or None"""
+        stdout.write(script.stdout)
+        stderr.write(script.stderr)
+        for fname, contents in script.files.items():
+            with open(os.path.join(cwd, fname), 'w') as outfile:
+                outfile.write(contents)
+        if script.clears:
+            workspace.clear()
+        workspace.update(script.variables)
+        if script.leak:
+            self.leaked.append(bytearray(b'\x01') * script.leak)
+        return script.error
+
+    def run(self, name: str, stdout, stderr):
+        self.ran.append(name)
+        script = self._script_for(name)
+        cwd = self.cwd
+
+        def complete():
+            return self._complete(script, cwd, stdout, stderr, self.workspace)
+
+        return FakeFuture(complete, None if script.hang else script.duration, script.ignore_cancel)
+
+    def run_batch(self, names, variable: str, stdout, stderr):
+        self.ran.extend(names)
+        scripts = [self._script_for(name) for name in names]
+        cwd = self.cwd
+        results = []
+
+        def complete():
+            for script in scripts:
+                workspace = dict(self.workspace)
+                output = io.StringIO()
+                error = self._complete(script, cwd, output, stderr, workspace)
+                value = workspace.get(variable) if error is None else None
+                results.append(BatchResult(value, output.getvalue(), error, script.duration))
+            return None
+
+        hang = any(script.hang for script in scripts)
+        duration = None if hang else sum(script.duration for script in scripts)
+        return FakeFuture(complete, duration, any(script.ignore_cancel for script in scripts), results)
+
+    def get_variable(self, name: str):
+        if name not in self.workspace:
+            raise KeyError(name)
+        return self.workspace[name]
+
+    def clear_workspace(self):
+        self.workspace = {}
+
+    def save_workspace(self, path: str):
+        with open(path, 'wb') as outfile:
+            pickle.dump(self.workspace, outfile)
+
+    def load_workspace(self, path: str):
+        with open(path, 'rb') as infile:
+            self.workspace.update(pickle.load(infile))
+
+    def quit(self):
+        self.workspace = {}
+        self.leaked = []
+
+ENGINES = {'matlab': MatlabEngine, 'fake': FakeEngine}
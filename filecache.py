@@ -0,0 +1,132 @@
+"""A content addressed cache of folders of matlab files on disk. Verification files are the same for
+every submission to an assignment, so rather than writing them out for every submission they are
+written once into a tree in the cache and hard linked into each evaluation folder."""
+
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import logging
+
+LOG = logging.getLogger(__name__)
+
+def tree_key(files) -> str:
+    """Gets the key of the tree that contains the given files. Files later in the list replace
+    earlier files with the same name, just like writing them out in order would. Uses the hash of
+    each file's contents that is already stored, so only the contents of files in trees which
+    need to be built are ever loaded.
+
+    Args:
+        files (iterable[MatlabFile]): the files in the tree
+    """
+    by_name = {}
+    for mfile in files:
+        by_name[mfile.name] = mfile.blob_id
+    digest = hashlib.sha256()
+    for name in sorted(by_name):
+        digest.update(f'{name}\0{by_name[name]}\0'.encode('utf-8'))
+    return digest.hexdigest()
+
+class FileTreeCache:
+    """Keeps folders of matlab files keyed by their names and contents. Trees are immutable once
+    built, so changing any of the files just means a new tree is built and the old tree is
+    eventually evicted. The files in a tree are read-only so that a script which writes to a linked
+    file fails rather than corrupting the cache for later submissions. Safe to share between
+    threads.
+
+    Attributes:
+        root (str): the folder that contains the trees
+        max_trees (int): the number of trees that are kept before the least recently used are removed
+    """
+    def __init__(self, root: str, max_trees: int = 256):
+        self.root = root
+        self.max_trees = max_trees
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def tree(self, files) -> str:
+        """Gets the folder that contains exactly the given files, building it if necessary
+
+        Args:
+            files (list[MatlabFile]): the files in the tree, as in tree_key
+        """
+        files = list(files)
+        key = tree_key(files)
+        path = os.path.join(self.root, key)
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                return path
+            if not os.path.isdir(path):
+                self._build(files, path)
+            self._recent[key] = path
+            while len(self._recent) > self.max_trees:
+                _, oldpath = self._recent.popitem(last=False)
+                self._remove(oldpath)
+        return path
+
+    def link(self, files, dest: str) -> list:
+        """Hard links the given files into the dest folder, replacing files with the same names.
+        Falls back to copying if the cache and dest are on different file systems.
+
+        Returns:
+            the names of the files that were placed in dest
+        """
+        files = list(files)
+        path = self.tree(files)
+        try:
+            return link_folder(path, dest)
+        except FileNotFoundError:
+            LOG.debug('Tree %s was evicted while linking; rebuilding', path)
+            with self._lock:
+                self._recent.pop(os.path.basename(path), None)
+            return link_folder(self.tree(files), dest)
+
+    def close(self):
+        """Removes every tree in the cache"""
+        with self._lock:
+            self._recent.clear()
+            self._remove(self.root)
+
+    def _build(self, files, path):
+        tmppath = tempfile.mkdtemp(prefix='.building-', dir=self.root)
+        try:
+            for mfile in files:
+                with open(os.path.join(tmppath, mfile.name), 'w') as outfile:
+                    outfile.write(mfile.contents)
+            for name in os.listdir(tmppath):
+                os.chmod(os.path.join(tmppath, name), 0o444)
+            os.rename(tmppath, path)
+        except OSError:
+            self._remove(tmppath)
+            if not os.path.isdir(path):
+                raise
+
+    def _remove(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+
+def link_folder(path: str, dest: str) -> list:
+    """Hard links every file in the folder at path into the dest folder, replacing files with the
+    same names and copying if hard links are not possible.
+
+    Returns:
+        the names of the files that were placed in dest
+    """
+    names = os.listdir(path)
+    for name in names:
+        _place(os.path.join(path, name), os.path.join(dest, name))
+    return names
+
+def _place(src, dest):
+    try:
+        os.link(src, dest)
+    except FileExistsError:
+        os.remove(dest)
+        os.link(src, dest)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dest)
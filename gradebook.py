@@ -0,0 +1,180 @@
+"""Exports the grades of each student in a group, one per assignment, with late penalties applied.
+The score for an assignment is taken from either the student's best or latest graded submission.
+Grades are computed by a single query and streamed in batches, so exporting a large course takes
+memory for one batch of rows rather than for every submission. Call with --help for details."""
+
+import argparse
+import csv
+import itertools
+import json
+import sys
+import typing
+
+from models import *
+
+FETCH_SIZE = 1000
+"""The number of rows fetched from the database at once"""
+
+POLICIES = {
+    'best': 'points DESC, submitted_at DESC, submission_id DESC',
+    'latest': 'submitted_at DESC, submission_id DESC',
+}
+"""The submission a grade is taken from for each policy, as the order in which a student's
+submissions for an assignment are ranked"""
+
+_GRADES_SQL = '''
+WITH selected AS (
+    SELECT id, group_id, name, late_at, late_penalty, closed_at FROM assignment WHERE {assignment_filter}
+), totals AS (
+    SELECT problem.assignment_id, SUM(problem.points_out_of) AS points_out_of
+    FROM problem JOIN selected ON selected.id = problem.assignment_id
+    GROUP BY problem.assignment_id
+), raw_scores AS (
+    SELECT submission.id AS submission_id, submission.assignment_id, submission.submittor_id AS person_id,
+           submission.submitted_at, COALESCE(SUM(submissionproblem.points), 0) AS raw_points,
+           CASE WHEN submission.submitted_at > selected.late_at THEN selected.late_penalty ELSE 0 END AS penalty
+    FROM submission
+    JOIN selected ON selected.id = submission.assignment_id
+    LEFT JOIN submissionproblem ON submissionproblem.submission_id = submission.id
+    WHERE submission.graded_at IS NOT NULL AND submission.submitted_at <= selected.closed_at
+    GROUP BY submission.id
+), scores AS (
+    SELECT raw_scores.*, ROUND(raw_points * (1 - penalty), 6) AS points FROM raw_scores
+), ranked AS (
+    SELECT submission_id, assignment_id, person_id, submitted_at, raw_points, penalty, points,
+           ROW_NUMBER() OVER (PARTITION BY assignment_id, person_id ORDER BY {order}) AS position,
+           COUNT(*) OVER (PARTITION BY assignment_id, person_id) AS submissions
+    FROM scores
+), roster AS (
+    SELECT persongroup.group_id, persongroup.person_id FROM persongroup
+    WHERE NOT persongroup.leader AND persongroup.group_id IN (SELECT group_id FROM selected)
+    UNION
+    SELECT selected.group_id, scores.person_id FROM scores JOIN selected ON selected.id = scores.assignment_id
+)
+SELECT "group".id, "group".name, person.id, person.name, selected.id, selected.name,
+       ranked.submission_id, ranked.submitted_at, COALESCE(ranked.submissions, 0), ranked.raw_points,
+       ranked.penalty, ranked.points, totals.points_out_of
+FROM roster
+JOIN "group" ON "group".id = roster.group_id
+JOIN person ON person.id = roster.person_id
+JOIN selected ON selected.group_id = roster.group_id
+LEFT JOIN totals ON totals.assignment_id = selected.id
+LEFT JOIN ranked ON ranked.assignment_id = selected.id AND ranked.person_id = roster.person_id AND ranked.position = 1
+ORDER BY "group".id, person.id, selected.id
+'''
+
+class Grade(typing.NamedTuple):
+    """The grade of one student for one assignment
+
+    Attributes:
+        group_id (int): the id of the group the assignment is for
+        group (str): the name of that group
+        person_id (int): the id of the student
+        person (str): the name of the student
+        assignment_id (int): the id of the assignment
+        assignment (str): the name of the assignment
+        submission_id (int): the id of the submission the grade is from, or None if the student
+            has no graded submission from before the assignment closed
+        submitted_at (str): when that submission was made or None
+        submissions (int): how many graded submissions the student made before the assignment closed
+        raw_points (float): the points the submission got before any late penalty or None
+        penalty (float): the fraction of the points taken off for being late or None
+        points (float): the points after the late penalty or None
+        points_out_of (float): the points the assignment is out of
+    """
+    group_id: int
+    group: str
+    person_id: int
+    person: str
+    assignment_id: int
+    assignment: str
+    submission_id: int
+    submitted_at: str
+    submissions: int
+    raw_points: float
+    penalty: float
+    points: float
+    points_out_of: float
+
+def grades(groups=None, assignments=None, policy: str = 'best') -> typing.Iterator[Grade]:
+    """Yields the grade of every student in the given groups for each of their assignments, ordered
+    by group, then student, then assignment. Students are the non-leader members of the group
+    and anyone who submitted to one of its assignments.
+
+    Args:
+        groups (list[int]): the ids of the groups to grade or None for every group
+        assignments (list[int]): if set then only these assignments are included
+        policy (str): which submission each grade is taken from, one of POLICIES
+    """
+    if policy not in POLICIES:
+        raise ValueError(f'expected policy is one of {sorted(POLICIES)} but got {policy}')
+    filters, params = [], []
+    for column, ids in (('group_id', groups), ('id', assignments)):
+        if ids is not None:
+            ids = list(ids)
+            filters.append(f'{column} IN ({", ".join("?" * len(ids))})' if ids else '0')
+            params.extend(ids)
+    sql = _GRADES_SQL.format(assignment_filter=' AND '.join(filters) or '1', order=POLICIES[policy])
+    cursor = DATABASE.execute_sql(sql, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield Grade(*row)
+    finally:
+        cursor.close()
+
+def write_csv(outfile, rows):
+    """Writes the given grades to the given text file as csv with one line per grade"""
+    writer = csv.writer(outfile)
+    writer.writerow(Grade._fields)
+    writer.writerows(rows)
+
+def write_wide_csv(outfile, rows):
+    """Writes the given grades, which must be ordered by group then student, to the given text file
+    as csv with one line per student and a column of points for each assignment. A header line
+    is written before the first student of each group"""
+    writer = csv.writer(outfile)
+    columns = None
+    for _, student in itertools.groupby(rows, key=lambda grade: (grade.group_id, grade.person_id)):
+        student = list(student)
+        if columns != [grade.assignment_id for grade in student]:
+            columns = [grade.assignment_id for grade in student]
+            writer.writerow(['group', 'person_id', 'person'] + [grade.assignment for grade in student] + ['total'])
+        total = sum(grade.points or 0 for grade in student)
+        writer.writerow([student[0].group, student[0].person_id, student[0].person]
+                        + ['' if grade.points is None else grade.points for grade in student] + [total])
+
+def write_json(outfile, rows):
+    """Writes the given grades to the given text file as a json array of objects, one per line"""
+    outfile.write('[')
+    separator = '\n'
+    for grade in rows:
+        outfile.write(separator + json.dumps(grade._asdict()))
+        separator = ',\n'
+    outfile.write('\n]\n')
+
+FORMATS = {'csv': write_csv, 'wide-csv': write_wide_csv, 'json': write_json}
+"""The functions which write grades in each output format"""
+
+def main():
+    """Entry point"""
+    parser = argparse.ArgumentParser(description='Exports the grades of each student for each assignment')
+    parser.add_argument('--group', action='append', type=int, help='The id of a group to export. May be given more than once; every group if not given', default=None)
+    parser.add_argument('--assignment', action='append', type=int, help='If given then only these assignments are exported. May be given more than once', default=None)
+    parser.add_argument('--policy', action='store', choices=sorted(POLICIES), help='Whether each grade is from the best or the latest graded submission made before the assignment closed', default='best')
+    parser.add_argument('--format', action='store', choices=sorted(FORMATS), help='csv has a line per student and assignment, wide-csv a line per student and json an object per student and assignment', default='csv')
+    parser.add_argument('--output', action='store', help='The file to write to, or - for stdout', default='-')
+    args = parser.parse_args()
+
+    rows = grades(args.group, args.assignment, args.policy)
+    if args.output == '-':
+        FORMATS[args.format](sys.stdout, rows)
+    else:
+        with open(args.output, 'w', newline='') as outfile:
+            FORMATS[args.format](outfile, rows)
+
+if __name__ == '__main__':
+    main()
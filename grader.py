@@ -1,149 +1,483 @@
 """This file actually performs grading for submissions"""
 
-import matlab.engine
-
 from models import *
+from engines import Engine, MatlabEngine
+from filecache import FileTreeCache, link_folder, tree_key
+from plans import GradingPlan, load_plan
+from pool import scratch_dir
+import metrics
+from reports import MAX_OUTPUT_BYTES, BoundedReport
+import atexit
+import collections
+import contextlib
 import os
+import shutil
 import tempfile
-import io
+import threading
+import weakref
 
 import logging
 import time
 
 MAX_TIME = 30
 LOG = logging.getLogger(__name__)
-ENGINE = matlab.engine.start_matlab()
 
-def _run_by_fname(fname, report):
+MAX_WARM_SETUPS = 4
+"""The most assignment setups kept per engine. Each keeps a folder and a workspace snapshot, by
+default in memory, so the least recently used is removed to make room for another"""
+
+_DEFAULT_ENGINE = None
+_DEFAULT_CACHE = None
+_DEFAULTS_LOCK = threading.Lock()
+
+_WARM_SETUPS = weakref.WeakKeyDictionary()
+_WARM_SETUPS_LOCK = threading.Lock()
+
+_SCRATCHES = weakref.WeakKeyDictionary()
+_SCRATCHES_LOCK = threading.Lock()
+
+PHASE_SECONDS = metrics.Histogram('matlab_evaluator_phase_seconds', 'Seconds spent in each phase of grading a submission',
+                                  ('phase', 'assignment'))
+GRADES = metrics.Counter('matlab_evaluator_grades', 'Submissions graded by how grading ended', ('outcome',))
+
+class VerificationError(Exception):
+    """Raised when a verification script run in a batch fails or does not set points"""
+
+def default_engine() -> Engine:
+    """Gets the engine used when grade is not given one, starting it if necessary"""
+    global _DEFAULT_ENGINE # pylint: disable=global-statement
+    with _DEFAULTS_LOCK:
+        if _DEFAULT_ENGINE is None:
+            _DEFAULT_ENGINE = MatlabEngine()
+        return _DEFAULT_ENGINE
+
+def default_cache() -> FileTreeCache:
+    """Gets the cache of verification files used when grade is not given one. It is removed when
+    the program exits"""
+    global _DEFAULT_CACHE # pylint: disable=global-statement
+    with _DEFAULTS_LOCK:
+        if _DEFAULT_CACHE is None:
+            _DEFAULT_CACHE = FileTreeCache(tempfile.mkdtemp(prefix='matlab-evaluator-trees-', dir=scratch_dir()))
+            atexit.register(_DEFAULT_CACHE.close)
+        return _DEFAULT_CACHE
+
+def _run_by_fname(engine, fname, report):
     print(f'Running {fname}', file=report)
-    engerr = io.StringIO()
-    engout = io.StringIO()
-    target = getattr(ENGINE, os.path.splitext(fname)[0])
-    future = target(nargout=0, stdout=engout, stderr=engerr, background=True)
-    starttime = time.time()
-    while not future.done():
-        if time.time() - starttime > MAX_TIME:
-            future.cancel()
-        time.sleep(0.1)
+    engerr = BoundedReport(MAX_OUTPUT_BYTES)
+    engout = BoundedReport(MAX_OUTPUT_BYTES)
+    future = engine.run(os.path.splitext(fname)[0], engout, engerr)
+    if not future.wait(MAX_TIME):
+        future.cancel()
     if not future.cancelled():
         future.result()
+    _print_output(report, engout.getvalue(), engerr.getvalue())
+    return future
+
+def _print_output(report, stdout, stderr):
     print('--STDOUT--', file=report)
-    print(engout.getvalue(), file=report)
+    print(stdout, file=report)
     print('--STDERR--', file=report)
-    print(engerr.getvalue(), file=report)
-    return future
+    print(stderr, file=report)
+
+class _Timings:
+    """Records how long each phase of grading a submission took
+
+    Attributes:
+        phases (list[tuple[str, float]]): the name of each phase and the number of seconds it took
+    """
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the body of the with statement as the phase with the given name"""
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - starttime))
+
+    def print(self, report):
+        """Prints the timing breakdown to the given report"""
+        print('=======TIMING=======', file=report)
+        for name, elapsed in self.phases:
+            print(f'{name}: {elapsed:.3f}s', file=report)
+
+class _Scratch:
+    """The folders an engine grades submissions in. Each submission gets new, empty folders with
+    a name of its own, since matlab caches scripts by path and could otherwise run a stale copy of
+    a script with the same name from an earlier submission
+
+    Attributes:
+        root (str): the folder which contains the others
+        jobs (int): the number of submissions which have been given folders
+        submission (str): the folder the current submission runs in, or None
+        verification (str): the folder the current verification scripts run in, or None
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.jobs = 0
+        self.submission = None
+        self.verification = None
+
+    def clear(self) -> tuple:
+        """Removes the folders of the previous submission and creates new ones
+
+        Returns:
+            the submission and verification folders
+        """
+        self.empty()
+        self.jobs += 1
+        self.submission = os.path.join(self.root, 'submission', str(self.jobs))
+        self.verification = os.path.join(self.root, 'verification', str(self.jobs))
+        os.mkdir(self.submission)
+        os.mkdir(self.verification)
+        return self.submission, self.verification
+
+    def empty(self):
+        """Removes the folders of the previous submission, along with any left by an earlier run"""
+        _clear_folder(os.path.join(self.root, 'submission'))
+        _clear_folder(os.path.join(self.root, 'verification'))
+        self.submission = None
+        self.verification = None
+
+def _clear_folder(path):
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        os.makedirs(path)
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+def _scratch(engine) -> _Scratch:
+    """Gets the scratch folders for the given engine. They are in the engine's workdir, or for an
+    engine without one, in a folder in pool.scratch_dir() which is removed when the program exits"""
+    with _SCRATCHES_LOCK:
+        scratch = _SCRATCHES.get(engine)
+        if scratch is None:
+            if engine.workdir is not None:
+                root = os.path.join(engine.workdir, 'scratch')
+                os.makedirs(root, exist_ok=True)
+            else:
+                root = tempfile.mkdtemp(prefix='matlab-evaluator-', dir=scratch_dir())
+                atexit.register(shutil.rmtree, root, ignore_errors=True)
+            scratch = _Scratch(root)
+            _SCRATCHES[engine] = scratch
+        return scratch
+
+def _write_files(folder, files):
+    """Writes the given matlab files into the folder, later files replacing earlier files with the
+    same name"""
+    by_name = {}
+    for mfile in files:
+        by_name[mfile.name] = mfile.contents
+    for name, contents in by_name.items():
+        with open(os.path.join(folder, name), 'w') as outfile:
+            outfile.write(contents)
 
-class _WrappedContextManager:
-    def __init__(self, ctxt_manager):
-        self.ctxt_manager = ctxt_manager
-        self.oldpath = None
+class _WarmSetup:
+    """The result of running an assignment's verification entry file once on an engine
 
-    def __enter__(self):
-        self.oldpath = ENGINE.cd('.')
-        return self.ctxt_manager.__enter__()
+    Attributes:
+        key (str): the tree_key of the assignment verification files when the setup ran
+        root (str): the folder which contains everything for this setup
+        folder (str): the folder the setup ran in, including any files it wrote
+        workspace (str): the path to the snapshot of the workspace after the setup ran
+    """
+    def __init__(self, key, root):
+        self.key = key
+        self.root = root
+        self.folder = os.path.join(root, 'files')
+        self.workspace = os.path.join(root, 'workspace.mat')
 
-    def __exit__(self, *args):
-        ENGINE.cd(self.oldpath)
-        return self.ctxt_manager.__exit__(*args)
+def _warm_setup(engine, cache, assignment, assign_files, report):
+    """Gets the warm setup for the given assignment plan on the given engine, running the setup
+    in a clean workspace if it has not been run with the current verification files yet. The
+    workspace is cleared again once the setup is saved, so that the submission does not see its
+    variables. Returns None if the setup timed out"""
+    with _WARM_SETUPS_LOCK:
+        setups = _WARM_SETUPS.setdefault(engine, collections.OrderedDict())
+    key = tree_key(assign_files)
+    setup = setups.get(assignment.assignment.id)
+    if setup is not None and setup.key == key:
+        setups.move_to_end(assignment.assignment.id)
+        print('Restoring assignment setup from snapshot', file=report)
+        return setup
+    if setup is not None:
+        del setups[assignment.assignment.id]
+        shutil.rmtree(setup.root, ignore_errors=True)
+    while len(setups) >= MAX_WARM_SETUPS:
+        _, evicted = setups.popitem(last=False)
+        shutil.rmtree(evicted.root, ignore_errors=True)
 
-def _wrap(ctxt_manager):
-    return _WrappedContextManager(ctxt_manager)
+    setup = _WarmSetup(key, tempfile.mkdtemp(prefix='setup-', dir=_scratch(engine).root))
+    try:
+        os.mkdir(setup.folder)
+        cache.link(assign_files, setup.folder)
+        engine.clear_workspace()
+        engine.cd(setup.folder)
+        print('Running assignment setup once for this engine', file=report)
+        future = _run_by_fname(engine, assignment.verification_entry_file.name, report)
+        if future.cancelled():
+            shutil.rmtree(setup.root, ignore_errors=True)
+            return None
+        engine.save_workspace(setup.workspace)
+        engine.clear_workspace()
+        for name in os.listdir(setup.folder):
+            os.chmod(os.path.join(setup.folder, name), 0o444)
+    except:
+        shutil.rmtree(setup.root, ignore_errors=True)
+        raise
+    setups[assignment.assignment.id] = setup
+    return setup
+
+def _verify_sequential(engine, cache, assignment, evaldir, report, timings, results) -> bool:
+    """Runs each problem's verification script in turn in evaldir, appending (ProblemPlan, points)
+    to results. Returns False if a script timed out"""
+    for problem_plan in assignment.problems:
+        problem = problem_plan.problem
+        linked = cache.link(problem_plan.auxilary_files + [problem_plan.verification_entry_file], evaldir)
+
+        print(f'Grading problem {problem.id}', file=report)
+        with timings.phase(f'problem {problem.id}'):
+            future = _run_by_fname(engine, problem_plan.verification_entry_file.name, report)
+        if future.cancelled():
+            return False
+        del future
+
+        points = float(engine.get_variable('points'))
+        print(f'Got {points}/{problem.points_out_of}', file=report)
+        results.append((problem_plan, points))
+
+        for name in linked:
+            os.remove(os.path.join(evaldir, name))
+    return True
+
+def _batchable(assignment, evaldir) -> bool:
+    """Determines if every problem's verification files can be placed in evaldir at once, which
+    is not possible if two problems have different files with the same name or if a problem
+    replaces a file which is already there"""
+    hashes = {}
+    for problem_plan in assignment.problems:
+        for mfile in problem_plan.auxilary_files + [problem_plan.verification_entry_file]:
+            if hashes.setdefault(mfile.name, mfile.blob_id) != mfile.blob_id:
+                return False
+    existing = set(os.listdir(evaldir))
+    return bool(hashes) and not existing.intersection(hashes)
+
+def _verify_batch(engine, cache, assignment, evaldir, report, timings, results) -> bool:
+    """Runs every problem's verification script in evaldir in a single engine call, appending
+    (ProblemPlan, points) to results. The whole batch gets MAX_TIME seconds; if it takes longer the
+    problems are verified one at a time instead, where each gets MAX_TIME seconds, so a script which
+    hangs costs about MAX_TIME more than it would have otherwise. Returns False if a script timed out"""
+    files = []
+    for problem_plan in assignment.problems:
+        files.extend(problem_plan.auxilary_files + [problem_plan.verification_entry_file])
+    linked = cache.link(files, evaldir)
+
+    fnames = [problem_plan.verification_entry_file.name for problem_plan in assignment.problems]
+    print(f'Running {len(fnames)} verification scripts in one batch', file=report)
+    engerr = BoundedReport(MAX_OUTPUT_BYTES)
+    engout = BoundedReport(MAX_OUTPUT_BYTES)
+    with timings.phase('verification'):
+        future = engine.run_batch([os.path.splitext(fname)[0] for fname in fnames], 'points', engout, engerr)
+        if not future.wait(MAX_TIME):
+            future.cancel()
+    if future.cancelled():
+        _print_output(report, engout.getvalue(), engerr.getvalue())
+        print(f'The batch did not finish within {MAX_TIME}s - verifying problems one at a time', file=report)
+        for name in linked:
+            os.remove(os.path.join(evaldir, name))
+        return _verify_sequential(engine, cache, assignment, evaldir, report, timings, results)
+    batch = future.result()
+    _print_output(report, engout.getvalue(), engerr.getvalue())
+
+    for problem_plan, fname, result in zip(assignment.problems, fnames, batch):
+        problem = problem_plan.problem
+        print(f'Grading problem {problem.id}', file=report)
+        print(f'Running {fname}', file=report)
+        _print_output(report, result.output, result.error or '')
+        timings.phases.append((f'problem {problem.id}', result.elapsed))
+        if result.error is not None:
+            raise VerificationError(f'{fname} failed: {result.error}')
+        if result.value is None:
+            raise VerificationError(f'{fname} did not set points')
+
+        points = float(result.value)
+        print(f'Got {points}/{problem.points_out_of}', file=report)
+        results.append((problem_plan, points))
+    return True
 
-def grade(submission: Submission) -> bool:
-    """Grades the specified submission, returning True on success and False on failure"""
-    assignment = submission.assignment
-    oldpath = ENGINE.cd('.')
+def _save_results(submission, plan, results, report, memo_key=None):
+    """Saves the results of grading in a single transaction, replacing any saved results for the
+    same problems. memo_key is the plan's memo key if the results may be copied to submissions with
+    the same inputs, otherwise None"""
+    rows = [{'submission': submission, 'problem': problem_plan.problem, 'points': points,
+             'points_out_of': problem_plan.problem.points_out_of} for problem_plan, points in results]
+    with DATABASE.atomic(lock_type='IMMEDIATE'):
+        # another grader may have saved results for this submission since the plan was loaded
+        if rows:
+            SubmissionProblem.insert_many(rows).on_conflict(
+                conflict_target=[SubmissionProblem.submission, SubmissionProblem.problem],
+                update={SubmissionProblem.points: EXCLUDED.points,
+                        SubmissionProblem.points_out_of: EXCLUDED.points_out_of}).execute()
+        submission.report = report
+        submission.graded_at = time.time()
+        submission.save()
+        GradingMemo.delete().where(GradingMemo.submission == submission).execute()
+        if memo_key is not None:
+            GradingMemo.insert(key=memo_key, submission=submission).on_conflict_replace().execute()
+
+def _copy_results(submission, plan, source):
+    """Copies the results of the given source submission, which had the same inputs, to the submission"""
+    points = {subm_problem.problem_id: subm_problem.points
+              for subm_problem in SubmissionProblem.select().where(SubmissionProblem.submission == source)}
+    results = [(problem_plan, points[problem_plan.problem.id]) for problem_plan in plan.assignment.problems
+               if problem_plan.problem.id in points]
+    if source.id == submission.id:
+        LOG.info('Submission %s is unchanged since it was last graded - not grading again', submission.id)
+        _save_results(submission, plan, results, source.report, plan.memo_key())
+    else:
+        LOG.info('Submission %s has the same inputs as submission %s - copying its results', submission.id, source.id)
+        report = f'Inputs are identical to submission id={source.id}; copied its results\n{source.report}'
+        _save_results(submission, plan, results, report)
+    return True
+
+def grade(submission: Submission, engine: Engine = None, cache: FileTreeCache = None, plan: GradingPlan = None,
+          warm_setup: bool = False, force: bool = False, batch_verification: bool = False) -> bool:
+    """Grades the specified submission, returning True on success and False on failure.
 
-    report = io.StringIO()
-    print(f'Evaluating submission id={submission.id} by {submission.submittor.name}', file=report)
+    Args:
+        submission (Submission): the submission to grade
+        engine (Engine): the engine to grade with. If None, the default engine is used
+        cache (FileTreeCache): where verification files are linked from. If None, the default
+            cache is used
+        plan (GradingPlan): the plan for the submission, if already loaded with plans.load_plans
+        warm_setup (bool): if True, the assignment verification entry file is run once per engine
+            rather than once per submission, and a snapshot of the workspace it leaves is restored
+            before verifying each submission. The setup runs in a clean workspace before the
+            submission rather than after it, so it must not depend on what the submission produces
+        force (bool): if False and a submission with exactly the same inputs has been graded, its
+            results are copied instead of running anything. If True the submission is always run
+        batch_verification (bool): if True, every problem's verification script is run in a single
+            engine call, each in its own function scope starting from the workspace left by the
+            assignment setup, so problems cannot see each other's variables. Falls back to one
+            call per problem if the problems' files cannot all be placed in one folder
+    """
+    if engine is None:
+        engine = default_engine()
+    if cache is None:
+        cache = default_cache()
+    loadtime = time.perf_counter()
+    if plan is None:
+        plan = load_plan(submission.id)
+    memo_key = plan.memo_key()
+    if not force:
+        memo = (GradingMemo.select(GradingMemo, Submission)
+                .join(Submission)
+                .where(GradingMemo.key == memo_key)
+                .first())
+        if memo is not None:
+            GRADES.inc(outcome='copied')
+            return _copy_results(submission, plan, memo.submission)
+    assignment = plan.assignment
+    scratch = _scratch(engine)
+    PHASE_SECONDS.observe(time.perf_counter() - loadtime, phase='load', assignment=assignment.assignment.id)
+
+    report = BoundedReport()
+    timings = _Timings()
+    results = []
+    memoizable = False
+    outcome = 'error'
+    starttime = time.perf_counter()
+    print(f'Evaluating submission id={submission.id} by {plan.submittor_name}', file=report)
+    assign_entry_file = assignment.verification_entry_file
+    assign_files = [] if assign_entry_file is None else [assign_entry_file]
+    assign_files.extend(assignment.auxilary_files)
     try:
-        with _wrap(tempfile.TemporaryDirectory()) as submdir:
-            entry_problem = submission.submission_entry_file
-            with open(os.path.join(submdir, entry_problem.name), 'w') as outfile:
-                outfile.write(entry_problem.contents)
+        setup = None
+        if warm_setup and assign_entry_file is not None:
+            with timings.phase('setup'):
+                setup = _warm_setup(engine, cache, assignment, assign_files, report)
+            if setup is None:
+                print('Operation cancelled due to timeout -> not grading', file=report)
+                outcome = 'timeout'
+                return True
 
-            for auxfile in submission.auxilary_files.join(MatlabFile):
-                with open(os.path.join(submdir, auxfile.auxfile.name), 'w') as outfile:
-                    outfile.write(auxfile.auxfile.contents)
+        with timings.phase('files'):
+            submdir, evaldir = scratch.clear()
+            entry_problem = plan.entry_file
+            _write_files(submdir, [entry_problem] + plan.auxilary_files)
 
-            ENGINE.cd(submdir)
-            future = _run_by_fname(entry_problem.name, report)
+        engine.cd(submdir)
+        with timings.phase('submission'):
+            future = _run_by_fname(engine, entry_problem.name, report)
+        if future.cancelled():
+            print('Operation cancelled due to timeout -> not grading', file=report)
+            outcome = 'timeout'
+            return True
+        del future
+
+        missing_prod_files = []
+        for prod_file in assignment.produced_files:
+            if not os.path.exists(os.path.join(submdir, prod_file)):
+                missing_prod_files.append(prod_file)
+            elif not missing_prod_files:
+                os.rename(os.path.join(submdir, prod_file), os.path.join(evaldir, prod_file))
+
+        if missing_prod_files:
+            print('Failed to find the following files after evaluating: ' + ', '.join(missing_prod_files), file=report)
+            memoizable = True
+            outcome = 'missing_files'
+            return True
+
+        with timings.phase('files'):
+            cache.link(assign_files, evaldir)
+            if setup is not None:
+                link_folder(setup.folder, evaldir)
+
+        print("=======VERIFICATION=======", file=report)
+        engine.cd(evaldir)
+        if setup is not None:
+            with timings.phase('restore'):
+                engine.load_workspace(setup.workspace)
+        elif assign_entry_file is not None:
+            print(f'Assignment entry file detected')
+            with timings.phase('setup'):
+                future = _run_by_fname(engine, assign_entry_file.name, report)
             if future.cancelled():
                 print('Operation cancelled due to timeout -> not grading', file=report)
+                outcome = 'timeout'
                 return True
             del future
 
-            with _wrap(tempfile.TemporaryDirectory()) as evaldir:
-                missing_prod_files = []
-                for prod_file in assignment.produced_files:
-                    if not os.path.exists(os.path.join(submdir, prod_file.filename)):
-                        missing_prod_files.append(prod_file.filename)
-                    elif not missing_prod_files:
-                        os.rename(os.path.join(submdir, prod_file.filename), os.path.join(evaldir, prod_file.filename))
-
-                if missing_prod_files:
-                    print('Failed to find the following files after evaluating: ' + ', '.join(missing_prod_files), file=report)
-                    return True
-
-                assign_entry_file = assignment.assignment_verification_entry_file
-
-                if assign_entry_file is not None:
-                    with open(os.path.join(evaldir, assign_entry_file.name), 'w') as outfile:
-                        outfile.write(assign_entry_file.contents)
-
-                for verfile in assignment.auxilary_verification_files.join(MatlabFile):
-                    with open(os.path.join(evaldir, verfile.auxfile.name), 'w') as outfile:
-                        outfile.write(verfile.auxfile.contents)
-
-                print("=======VERIFICATION=======", file=report)
-                ENGINE.cd(evaldir)
-                if assign_entry_file is not None:
-                    print(f'Assignment entry file detected')
-                    future = _run_by_fname(assign_entry_file.name, report)
-                    if future.cancelled():
-                        print('Operation cancelled due to timeout -> not grading', file=report)
-                        return True
-                    del future
-
-                for problem in assignment.problems.join(MatlabFile):
-                    verfiles = problem.auxilary_verification_files.join(MatlabFile)
-                    for verfile in verfiles:
-                        with open(os.path.join(evaldir, verfile.auxfile.name), 'w') as outfile:
-                            outfile.write(verfile.auxfile.contents)
-
-                    with open(os.path.join(evaldir, problem.verification_entry_file.name), 'w') as outfile:
-                        outfile.write(problem.verification_entry_file.contents)
-
-                    print(f'Grading problem {problem.id}', file=report)
-                    future = _run_by_fname(problem.verification_entry_file.name, report)
-                    if future.cancelled():
-                        print('Operation cancelled due to timeout -> not grading', file=report)
-                        return True
-                    del future
-
-                    points = float(ENGINE.workspace['points'])
-                    print(f'Got {points}/{problem.points_out_of}', file=report)
-                    subm_problem = submission.submission_problems.where(SubmissionProblem.problem == problem).first()
-                    if subm_problem is None:
-                        subm_problem = SubmissionProblem.create(submission=submission, problem=problem, points_out_of=problem.points_out_of, points=points)
-                    else:
-                        subm_problem.points = points
-                        subm_problem.points_out_of = problem.points_out_of
-                        subm_problem.save()
-
-                    for verfile in verfiles:
-                        os.remove(os.path.join(evaldir, verfile.auxfile.name))
-                    os.remove(os.path.join(evaldir, problem.verification_entry_file.name))
-                ENGINE.cd(oldpath)
+        verify = _verify_sequential
+        if batch_verification and _batchable(assignment, evaldir):
+            verify = _verify_batch
+        if not verify(engine, cache, assignment, evaldir, report, timings, results):
+            print('Operation cancelled due to timeout -> not grading', file=report)
+            outcome = 'timeout'
+            return True
         print('Grading finished successfully', file=report)
+        memoizable = True
+        outcome = 'graded'
         return True
     except:
         LOG.error('Exception occurred while grading submission %s', str(submission.id), exc_info=1)
         raise
     finally:
-        LOG.debug(report.getvalue())
-        ENGINE.cd(oldpath)
-        submission.report = report.getvalue()
-        submission.graded_at = time.time()
-        submission.save()
+        timings.phases.append(('total', time.perf_counter() - starttime))
+        timings.print(report)
+        for name, elapsed in timings.phases:
+            PHASE_SECONDS.observe(elapsed, phase=name.split(' ')[0], assignment=assignment.assignment.id)
+        GRADES.inc(outcome=outcome)
+        LOG.info('Submission %s: %s in %.3fs', submission.id, outcome, timings.phases[-1][1])
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(report.getvalue())
+        _save_results(submission, plan, results, report.getvalue(), memo_key if memoizable else None)
+        scratch.empty()
     return False
@@ -0,0 +1,117 @@
+"""Extends the persistqueue ack queue with batched operations so that grading many short jobs does
+not cost several sqlite transactions per job"""
+
+import time
+
+import persistqueue
+from persistqueue.sqlackqueue import AckStatus
+
+WAKE_INTERVAL = 0.01
+"""How often, in seconds, a blocked get_batch checks whether another process has added jobs"""
+
+class BatchAckQueue(persistqueue.SQLiteAckQueue):
+    """A SQLiteAckQueue which can get, ack, nack and put many items in a single transaction and
+    which blocks for new items without counting the queue. Items put by other processes are noticed
+    within WAKE_INTERVAL seconds through sqlite's data_version, which is much cheaper than a query
+    against the queue table."""
+    _SQL_SELECT_BATCH = (
+        'SELECT {key_column}, data, timestamp FROM {table_name} '
+        'WHERE status < %s ORDER BY {key_column} ASC LIMIT ?' % AckStatus.unack
+    )
+    _SQL_COUNT_WAITING = 'SELECT COUNT(*) FROM {table_name} WHERE status < %s' % AckStatus.unack
+    _SQL_CREATE_STATUS_INDEX = (
+        'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} (status, {key_column})'
+    )
+
+    def _init(self):
+        super()._init()
+        self._conn.execute(self._SQL_CREATE_STATUS_INDEX.format(
+            index_name=f'{self._TABLE_NAME}_{self.name}_status', table_name=self._table_name,
+            key_column=self._key_column))
+        self._conn.commit()
+
+    def _data_version(self):
+        return self._getter.execute('PRAGMA data_version').fetchone()[0]
+
+    def waiting_count(self) -> int:
+        """Counts the items which are waiting to be fetched, including those put by other processes.
+        Unlike ready_count this includes items which have never been fetched, not just nacked ones"""
+        return self._getter.execute(self._SQL_COUNT_WAITING.format(table_name=self._table_name)).fetchone()[0]
+
+    def _mark_batch(self, keys, status):
+        with self.tran_lock:
+            with self._putter as tran:
+                tran.executemany(self._sql_mark_ack_status, [(status, key) for key in keys])
+
+    def _pop_batch(self, size):
+        with self.action_lock:
+            sql = self._SQL_SELECT_BATCH.format(table_name=self._table_name, key_column=self._key_column)
+            rows = self._getter.execute(sql, (size,)).fetchall()
+            if not rows:
+                return []
+            self._mark_batch([row[0] for row in rows], AckStatus.unack)
+            result = []
+            for key, data, timestamp in rows:
+                item = self._serializer.loads(data)
+                self._unack_cache[key] = item
+                result.append({'pqid': key, 'data': item, 'timestamp': timestamp})
+            self.total -= len(rows)
+            return result
+
+    def get_batch(self, size: int, timeout: float = None) -> list:
+        """Gets up to size items, waiting up to timeout seconds for at least one to be available
+        (forever if timeout is None). Items are marked unacked in a single transaction.
+
+        Returns:
+            the raw items (dicts with 'pqid', 'data' and 'timestamp') which were fetched. Empty if
+            the timeout passed without any items becoming available
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self.put_event.clear()
+            version = self._data_version()
+            items = self._pop_batch(size)
+            if items:
+                return items
+            while True:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return []
+                wait = WAKE_INTERVAL if remaining is None else min(WAKE_INTERVAL, remaining)
+                if self.put_event.wait(wait) or self._data_version() != version:
+                    break
+
+    def ack_batch(self, keys):
+        """Acks the items with the given pqids in a single transaction"""
+        self._finish_batch(keys, AckStatus.acked)
+
+    def ack_failed_batch(self, keys):
+        """Marks the items with the given pqids as failed in a single transaction"""
+        self._finish_batch(keys, AckStatus.ack_failed)
+
+    def nack_batch(self, keys):
+        """Returns the items with the given pqids to the queue in a single transaction"""
+        keys = list(keys)
+        self._finish_batch(keys, AckStatus.ready)
+        self.total += len(keys)
+
+    def _finish_batch(self, keys, status):
+        keys = list(keys)
+        if not keys:
+            return
+        with self.action_lock:
+            self._mark_batch(keys, status)
+            for key in keys:
+                self._unack_cache.pop(key, None)
+
+    def put_batch(self, items):
+        """Puts all of the given items in a single transaction"""
+        now = time.time()
+        records = [(self._serializer.dumps(item), now) for item in items]
+        if not records:
+            return
+        with self.tran_lock:
+            with self._putter as tran:
+                tran.executemany(self._sql_insert, records)
+        self.total += len(records)
+        self.put_event.set()
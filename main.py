@@ -3,16 +3,42 @@ the push_job.py and fetch jobs via fetch_job.py if that's easier than using pers
 directly"""
 
 import argparse
+import collections
+import concurrent.futures
+import functools
 import os
 import time
 
+from broker import SQLiteBroker, TCPBroker
 import grader
-import persistqueue
+import metrics
+import migrations
+from engines import ENGINES
+from filecache import FileTreeCache
+from pool import EnginePool
+from scheduler import Scheduler
+from supervisor import EngineCrashedError, ProcessEngine
 import logging
 import logging.config
 import json
 
-from models import Submission
+from plans import load_plan, load_plans
+
+QUEUE_DEPTH = metrics.Gauge('matlab_evaluator_queue_depth', 'Jobs waiting in each queue, including jobs read ahead by the scheduler', ('queue',))
+JOBS = metrics.Counter('matlab_evaluator_jobs', 'Queued jobs finished by what happened to them', ('result',))
+JOBS_PER_SECOND = metrics.Gauge('matlab_evaluator_jobs_per_second', 'Queued jobs finished per second over the last minute')
+JOB_LATENCY = metrics.Histogram('matlab_evaluator_job_latency_seconds', 'Seconds from a job being queued to it being finished')
+PLAN_LOAD_SECONDS = metrics.Histogram('matlab_evaluator_plan_load_seconds', 'Seconds spent loading the plans for the jobs handed to engines at once')
+
+THROUGHPUT_WINDOW = 60.0
+"""The number of seconds jobs per second is averaged over"""
+
+QUEUE_DEPTH_INTERVAL = 1.0
+"""The least number of seconds between checking how many jobs are waiting in each queue"""
+
+BROKER_LOOKAHEAD_PER_WORKER = 2
+"""The most jobs read ahead per worker when fetching from a broker server, since jobs read ahead
+are leased to this machine and cannot be graded by any other"""
 
 def verify_database_filepath(filepath):
     """Verifies the given path is a valid database folder"""
@@ -36,59 +62,176 @@ def load_logging(logging_conf):
         config = json.load(infile)
         logging.config.dictConfig(config)
 
-def main():
-    """Entry point"""
+def grade_job(engine, job, plan, options):
+    """Grades the submission with the given id on the given engine, using the plan for it if
+    it was loaded and passing the given options on to grader.grade"""
+    if not isinstance(job, int):
+        raise ValueError(f'expected job is int (id of submission to grade or regrade)')
+
+    if plan is None:
+        plan = load_plan(job)
+    logging.getLogger(__name__).info('Grading submission %s', job)
+    grader.grade(plan.submission, engine, plan=plan, **options)
+
+def main(argv=None):
+    """Entry point. Parses the given arguments, or the command line arguments if None"""
     parser = argparse.ArgumentParser()
     parser.add_argument('--input-database', action='store', help='The path to the folder which jobs are pushed to', default='in')
     parser.add_argument('--output-database', action='store', help='The path to the folder which evaluations are pushed to', default='out')
+    parser.add_argument('--broker', action='store', help='If set then jobs are fetched from and evaluations reported to the broker server at this HOST:PORT (see broker.py) instead of the input and output databases', default=None)
     parser.add_argument('--loop', action='store_true', help='Causes this to continuously read from the queue rather than terminate upon completion')
-    parser.add_argument('--sleep-time', action='store', type=float, help='Only used if --loop is set: time to sleep in seconds while waiting for work', default=0.1)
+    parser.add_argument('--sleep-time', action='store', type=float, help='Only used if --loop is set: the longest time in seconds to block while waiting for work before checking in on running jobs', default=0.1)
+    parser.add_argument('--batch-size', action='store', type=int, help='The number of finished jobs whose acks and outputs are committed at once. Jobs are read ahead up to --lookahead regardless', default=1)
+    parser.add_argument('--lookahead', action='store', type=int, help='The most jobs to read ahead of grading, so that they can be reordered by priority and assignment. Jobs are either a submission id or a dict like {"submission": id, "priority": n}; by default new submissions come before regrades. With --broker at most twice --workers', default=256)
     parser.add_argument('--logging-conf', action='store', help='The path to the json file from which we logging.config.dictConfig', default='conf/logging.json')
     parser.add_argument('--no-output', action='store_true', help='If set then this does not push completed jobs to the output queue')
     parser.add_argument('--skip-bad', action='store_true', help='If set then this skips bad entries instead of nacking and exitting')
-    args = parser.parse_args()
+    parser.add_argument('--workers', action='store', type=int, help='The number of matlab engines to grade with concurrently', default=1)
+    parser.add_argument('--warm-setup', action='store_true', help='If set then each engine runs an assignment verification entry file once and restores a snapshot of its workspace for each submission. Only valid if the entry file does not depend on the submission')
+    parser.add_argument('--batch-verification', action='store_true', help='If set then every problem of a submission is verified in a single engine call, each in its own function scope, rather than one call per problem')
+    parser.add_argument('--force', action='store_true', help='If set then submissions are always run, even if a submission with identical files has already been graded')
+    parser.add_argument('--engine', action='store', choices=sorted(ENGINES), help='The engine to grade with. The fake engine does not need matlab and is only useful for benchmarking', default='matlab')
+    parser.add_argument('--isolate', action='store_true', help='If set then each engine runs in a child process which is killed and restarted if a script does not stop when it times out')
+    parser.add_argument('--kill-after', action='store', type=float, help='Only used if --isolate is set: seconds a timed out script has to stop before its engine is killed', default=5.0)
+    parser.add_argument('--max-jobs-per-engine', action='store', type=int, help='If set then engines are restarted after grading this many jobs', default=None)
+    parser.add_argument('--max-engine-memory', action='store', type=float, help='Only used if --isolate is set: engines using more than this many megabytes after a job are restarted', default=None)
+    parser.add_argument('--metrics-port', action='store', type=int, help='If set then metrics are served in the Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics', default=None)
+    parser.add_argument('--metrics-host', action='store', help='Only used if --metrics-port is set: the address to serve metrics on', default='127.0.0.1')
+    parser.add_argument('--metrics-file', action='store', help='If set then metrics are written to this file in the Prometheus text format every --metrics-interval seconds', default=None)
+    parser.add_argument('--metrics-interval', action='store', type=float, help='Only used if --metrics-file is set: the seconds between writing metrics', default=15.0)
+    parser.add_argument('--max-attempts', action='store', type=int, help='The number of times a job is tried when its engine crashes before it counts as failed', default=3)
+    args = parser.parse_args(argv)
 
-    verify_database_filepath(args.input_database)
-    verify_database_filepath(args.output_database)
+    if args.broker is None:
+        verify_database_filepath(args.input_database)
+        verify_database_filepath(args.output_database)
 
     load_logging(args.logging_conf)
     logger = logging.getLogger(__name__)
+    migrations.migrate()
+
+    if args.broker is not None:
+        jobque = TCPBroker(args.broker)
+    else:
+        jobque = SQLiteBroker(args.input_database, None if args.no_output else args.output_database)
+
+    finish_times = collections.deque()
+    depth_checked_at = 0.0
+
+    def commit(finished):
+        jobque.ack_batch([job['pqid'] for job in finished], [] if args.no_output else [job['data'] for job in finished])
+        finished.clear()
+
+    def record(items, result):
+        now = time.time()
+        JOBS.inc(len(items), result=result)
+        for item in items:
+            JOB_LATENCY.observe(now - item['timestamp'])
+            finish_times.append(now)
+        while finish_times and finish_times[0] < now - THROUGHPUT_WINDOW:
+            finish_times.popleft()
+        JOBS_PER_SECOND.set(len(finish_times) / THROUGHPUT_WINDOW)
+
+    def check_depths(scheduler):
+        nonlocal depth_checked_at
+        if time.monotonic() - depth_checked_at < QUEUE_DEPTH_INTERVAL:
+            return
+        depth_checked_at = time.monotonic()
+        depths = jobque.depths()
+        depths['in'] += sum(len(job.items) for job in scheduler.buffered.values())
+        for queue, depth in depths.items():
+            QUEUE_DEPTH.set(depth, queue=queue)
+
+    server = None if args.metrics_port is None else metrics.serve(args.metrics_port, args.metrics_host)
+    dumper = None if args.metrics_file is None else metrics.FileDumper(args.metrics_file, args.metrics_interval)
+
+    engine_factory = ENGINES[args.engine]
+    if args.isolate:
+        engine_factory = functools.partial(ProcessEngine, engine_factory, kill_after=args.kill_after)
+    max_memory = None if args.max_engine_memory is None else int(args.max_engine_memory * 2**20)
+
+    try:
+        with EnginePool(args.workers, engine_factory, max_jobs=args.max_jobs_per_engine, max_memory=max_memory) as pool:
+            options = {'cache': FileTreeCache(os.path.join(pool.rootdir, 'trees')),
+                       'warm_setup': args.warm_setup, 'force': args.force,
+                       'batch_verification': args.batch_verification}
+            lookahead = args.lookahead
+            if args.broker is not None:
+                lookahead = min(lookahead, BROKER_LOOKAHEAD_PER_WORKER * args.workers)
+            scheduler = Scheduler(jobque, lookahead)
+            pending = {}
+            finished = []
+            attempts = {}
+            error = None
+            while True:
+                if error is None:
+                    timeout = args.sleep_time if args.loop and not pending and not scheduler.buffered else 0
+                    scheduler.fill(timeout=timeout)
+                    jobs = []
+                    affinities = pool.idle_affinities()
+                    while len(pending) + len(jobs) < args.workers:
+                        job = scheduler.take(affinities)
+                        if job is None:
+                            break
+                        affinities.discard(job.assignment_id)
+                        jobs.append(job)
+                    check_depths(scheduler)
+                    loadtime = time.perf_counter()
+                    plans = load_plans([job.submission_id for job in jobs if job.submission_id is not None])
+                    if jobs:
+                        PLAN_LOAD_SECONDS.observe(time.perf_counter() - loadtime)
+                    for job in jobs:
+                        future = pool.submit(grade_job, job.data, plans.get(job.submission_id), options,
+                                             affinity=job.assignment_id)
+                        pending[future] = job
+
+                if not pending:
+                    commit(finished)
+                    if error is not None:
+                        raise error
+                    if not args.loop and not scheduler.buffered:
+                        return
+                    continue
+
+                timeout = args.sleep_time if error is None and len(pending) < args.workers else None
+                done, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    scheduler.finished(job)
+                    pqids = [item['pqid'] for item in job.items]
+                    exc = future.exception()
+                    if isinstance(exc, EngineCrashedError) and attempts.get(pqids[0], 1) < args.max_attempts:
+                        attempts[pqids[0]] = attempts.get(pqids[0], 1) + 1
+                        logger.warning('Engine crashed while grading job %s - returning it to the queue', job.data, exc_info=exc)
+                        JOBS.inc(len(pqids), result='retried')
+                        jobque.nack_batch(pqids)
+                        continue
+                    attempts.pop(pqids[0], None)
+                    if exc is not None:
+                        logger.error('failed to grade job', exc_info=exc)
+                        if args.skip_bad:
+                            logger.info('skipping failed job instead of erroring (skip_bad is True)')
+
+                    if exc is None or args.skip_bad:
+                        record(job.items, 'done' if exc is None else 'skipped')
+                        finished.extend(job.items)
+                    elif error is None:
+                        JOBS.inc(len(pqids), result='failed')
+                        logger.error('Failed to process job %s - nacking and terminating', job.data)
+                        error = exc
+                        jobque.nack_batch(pqids + [item['pqid'] for item in scheduler.drain()])
+                    else:
+                        JOBS.inc(len(pqids), result='failed')
+                        jobque.nack_batch(pqids)
 
-    jobque = persistqueue.SQLiteAckQueue(args.input_database)
-    if not args.no_output:
-        outque = persistqueue.SQLiteAckQueue(args.output_database)
-    stop = False
-    while not stop:
-        if jobque.size == 0:
-            if not args.loop:
-                return
-            time.sleep(args.sleep_time)
-            continue
-
-        job = jobque.get()
-        success = False
-        try:
-            if not isinstance(job, int):
-                raise ValueError(f'expected job is int (id of submission to grade or regrade)')
-
-            logger.info('Grading submission %s', job)
-            grader.grade(Submission.get_by_id(job))
-            success = True
-        except:
-            logger.error('failed to grade job', exc_info=1)
-            if not args.skip_bad:
-                raise
-            else:
-                logger.info('skipping failed job instead of erroring (skip_bad is True)')
-        finally:
-            if success or args.skip_bad:
-                jobque.ack(job)
-                if not args.no_output:
-                    outque.put(job)
-            else:
-                logger.error('Failed to process job %s - nacking and terminating', job)
-                jobque.nack(job)
-                stop = True
+                if len(finished) >= args.batch_size:
+                    commit(finished)
+    finally:
+        jobque.close()
+        if server is not None:
+            server.shutdown()
+        if dumper is not None:
+            dumper.stop()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""Counters, gauges and histograms describing the grading loop, which can be served over HTTP in
+the Prometheus text format or periodically written to a file (for example for node_exporter's
+textfile collector). Metrics are defined at the top of the modules which update them."""
+
+import http.server
+import logging
+import math
+import os
+import threading
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+"""The upper bounds in seconds of the buckets histograms use unless given others"""
+
+REGISTRY = []
+"""Every metric which has been defined, in the order they were defined"""
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+class _Metric:
+    """A metric with a value for each combination of label values
+
+    Attributes:
+        name (str): the name of the metric
+        documentation (str): what the metric measures
+        labelnames (tuple[str]): the names of the labels every update must give values for
+    """
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels) -> tuple:
+        if len(labels) != len(self.labelnames) or any(name not in labels for name in self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames} but got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        """Yields (suffix, label values, extra labels, value) for each sample"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Gets this metric in the Prometheus text format"""
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            samples = list(self._samples())
+        for suffix, values, extra, value in samples:
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+class Counter(_Metric):
+    """A value which only goes up, such as the number of jobs graded"""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """Adds the given amount to the value for the given labels"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """Gets the value for the given labels"""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield '_total', key, (), value
+
+class Gauge(Counter):
+    """A value which can go up and down, such as the number of jobs waiting"""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        """Sets the value for the given labels"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield '', key, (), value
+
+class Histogram(_Metric):
+    """Counts observations, such as how long each phase of grading took, in buckets
+
+    Attributes:
+        buckets (tuple[float]): the upper bounds of the buckets, not including +Inf
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        """Records one observation of the given value for the given labels"""
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def count(self, **labels) -> int:
+        """Gets the number of observations for the given labels"""
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return 0 if counts is None else counts[2]
+
+    def _samples(self):
+        for key, (buckets, total, count) in self._values.items():
+            for bound, bucket in zip(self.buckets, buckets):
+                yield '_bucket', key, (('le', _format_value(bound)),), bucket
+            yield '_bucket', key, (('le', '+Inf'),), count
+            yield '_sum', key, (), total
+            yield '_count', key, (), count
+
+def render() -> str:
+    """Gets every metric in the Prometheus text format"""
+    return ''.join(metric.render() for metric in REGISTRY)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self): # pylint: disable=invalid-name
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        LOG.debug(format, *args)
+
+def serve(port: int, host: str = '127.0.0.1') -> http.server.ThreadingHTTPServer:
+    """Serves every metric at /metrics on the given port from a background thread. Call shutdown()
+    on the returned server to stop"""
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    LOG.info('Serving metrics on http://%s:%s/metrics', host, server.server_address[1])
+    return server
+
+class FileDumper:
+    """Writes every metric to a file every interval seconds from a background thread. The file is
+    replaced atomically so readers never see a partial dump
+
+    Attributes:
+        path (str): the file the metrics are written to
+        interval (float): the number of seconds between dumps
+    """
+    def __init__(self, path: str, interval: float = 15.0):
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-dump', daemon=True)
+        self._thread.start()
+
+    def dump(self):
+        """Writes every metric to the file now"""
+        tmppath = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmppath, 'w') as outfile:
+            outfile.write(render())
+        os.replace(tmppath, self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.dump()
+            except OSError:
+                LOG.warning('Failed to write metrics to %s', self.path, exc_info=1)
+
+    def stop(self):
+        """Stops dumping, writing the metrics one last time"""
+        self._stopped.set()
+        self._thread.join()
+        self.dump()
@@ -0,0 +1,72 @@
+"""Upgrades databases created by older versions of this program. models.py creates any missing
+tables, but changes to existing tables are made here. The number of migrations which have been
+applied is kept in SQLite's user_version pragma, and each migration runs in its own transaction."""
+
+import logging
+
+from playhouse.migrate import SqliteMigrator, migrate as apply_operations
+
+from models import *
+
+LOG = logging.getLogger(__name__)
+
+def _columns(table: str) -> list:
+    return [column.name for column in DATABASE.get_columns(table)]
+
+def _move_reports():
+    """Moves reports out of the submission table into compressed SubmissionReport rows"""
+    if 'report' not in _columns('submission'):
+        return
+    cursor = DATABASE.execute_sql('SELECT id, report FROM submission WHERE report IS NOT NULL')
+    for submission_id, report in cursor:
+        SubmissionReport.store(submission_id, report)
+    apply_operations(SqliteMigrator(DATABASE).drop_column('submission', 'report'))
+
+def _deduplicate_files():
+    """Moves the contents of matlab files into FileBlob rows shared by files with the same contents"""
+    if 'contents' not in _columns('matlabfile'):
+        return
+    migrator = SqliteMigrator(DATABASE)
+    if 'blob_id' not in _columns('matlabfile'):
+        apply_operations(migrator.add_column('matlabfile', 'blob_id', ForeignKeyField(FileBlob, null=True, field=FileBlob.hash)))
+    rows = DATABASE.execute_sql('SELECT id, contents FROM matlabfile').fetchall()
+    for file_id, contents in rows:
+        DATABASE.execute_sql('UPDATE matlabfile SET blob_id = ? WHERE id = ?', (FileBlob.store(contents), file_id))
+    apply_operations(migrator.drop_column('matlabfile', 'contents'))
+
+def _add_indexes():
+    """Adds any missing foreign key indexes and a unique index on the submission and problem of
+    each SubmissionProblem, keeping the oldest of any duplicates since that is the one grading updates"""
+    for model in MODELS:
+        model._schema.create_indexes(safe=True) # pylint: disable=protected-access
+    DATABASE.execute_sql('CREATE INDEX IF NOT EXISTS matlabfile_blob_id ON matlabfile (blob_id)')
+    DATABASE.execute_sql('DELETE FROM submissionproblem WHERE id NOT IN '
+                         '(SELECT MIN(id) FROM submissionproblem GROUP BY submission_id, problem_id)')
+    DATABASE.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS submissionproblem_submission_id_problem_id '
+                         'ON submissionproblem (submission_id, problem_id)')
+
+def _drop_premature_indexes():
+    """Drops the blob index that importing models.py used to create before the blob column had
+    been added. SQLite accepts it by reading the missing column as a string, but then refuses to
+    drop any other column of the table"""
+    if 'blob_id' not in _columns('matlabfile'):
+        DATABASE.execute_sql('DROP INDEX IF EXISTS matlabfile_blob_id')
+
+MIGRATIONS = [_move_reports, _deduplicate_files, _add_indexes]
+"""Every migration in the order they were added. Only ever append to this list"""
+
+def migrate() -> int:
+    """Applies the migrations which have not been applied to the database yet
+
+    Returns:
+        the number of migrations applied
+    """
+    version = DATABASE.pragma('user_version')
+    if version < len(MIGRATIONS):
+        _drop_premature_indexes()
+    for index in range(version, len(MIGRATIONS)):
+        LOG.info('Migrating database: %s', MIGRATIONS[index].__doc__)
+        with DATABASE.atomic(lock_type='IMMEDIATE'):
+            MIGRATIONS[index]()
+            DATABASE.pragma('user_version', index + 1)
+    return max(len(MIGRATIONS) - version, 0)
@@ -1,13 +1,39 @@
-"""Describes the various models used in this program."""
+"""Describes the various models used in this program. The database is configured in
+conf/database.json, but its file can be overridden with the MATLAB_EVALUATOR_DATABASE environment
+variable (as the benchmarks do)."""
 
 from peewee import * # pylint: disable=unused-wildcard-import, wildcard-import
 import datetime
+import hashlib
 import json
+import os
+import zlib
 
 with open('conf/database.json', 'r') as infile:
     SETTINGS = json.load(infile)
 
-DATABASE = SqliteDatabase(SETTINGS['file'])
+if os.environ.get('MATLAB_EVALUATOR_DATABASE'):
+    SETTINGS['file'] = os.environ['MATLAB_EVALUATOR_DATABASE']
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 2**20,
+    'temp_store': 'memory',
+}
+"""The pragmas set on every connection unless overridden by "pragmas" in conf/database.json. The
+write-ahead log lets readers (such as the web front end) run while a grader writes, and normal
+synchronous is durable in wal mode except against power loss. cache_size is negative for KiB"""
+
+DEFAULT_BUSY_TIMEOUT = 30.0
+"""The seconds a connection waits for another connection's write to finish before failing with
+'database is locked', unless overridden by "busy_timeout" in conf/database.json"""
+
+DATABASE = SqliteDatabase(SETTINGS['file'], pragmas={**DEFAULT_PRAGMAS, **SETTINGS.get('pragmas', {})},
+                          timeout=SETTINGS.get('busy_timeout', DEFAULT_BUSY_TIMEOUT))
+"""The database, which gives each thread its own connection. Transactions which write after reading
+should begin with lock_type='IMMEDIATE' so that they wait for other writers instead of failing"""
 
 MODELS = []
 class BaseModel(Model):
@@ -16,15 +42,84 @@ class BaseModel(Model):
         """The database attachment"""
         database = DATABASE
 
+COMPRESS_FILES = SETTINGS.get('compress_files', True)
+"""If True the contents of files are stored compressed when that makes them smaller"""
+
+class FileBlob(BaseModel):
+    """The contents of one or more matlab files. Files with the same contents share a blob
+
+    Attributes:
+        hash (str): the hex sha256 of the contents as utf-8
+        size (int): the length of the contents in bytes
+        compressed (bool): True if data is zlib compressed, False if it is the contents as is
+        data (bytes): the contents as utf-8, possibly compressed
+    """
+    hash = CharField(primary_key=True)
+    size = IntegerField()
+    compressed = BooleanField()
+    data = BlobField()
+
+    @property
+    def text(self) -> str:
+        """The contents of the blob"""
+        data = zlib.decompress(self.data) if self.compressed else bytes(self.data)
+        return data.decode('utf-8')
+
+    @staticmethod
+    def hash_of(text: str) -> str:
+        """Gets the hash of the blob with the given contents"""
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def store(cls, text: str) -> str:
+        """Stores a blob with the given contents if there is not one already
+
+        Returns:
+            the hash of the blob
+        """
+        data = text.encode('utf-8')
+        key = hashlib.sha256(data).hexdigest()
+        size = len(data)
+        compressed = False
+        if COMPRESS_FILES:
+            packed = zlib.compress(data)
+            if len(packed) < len(data):
+                data, compressed = packed, True
+        cls.insert(hash=key, size=size, compressed=compressed, data=data).on_conflict_ignore().execute()
+        return key
+MODELS.append(FileBlob)
+
 class MatlabFile(BaseModel):
     """Describes a matlab file
 
     Attributes:
         name (str): the name of the file, ending with '.m'
-        contents (str): the contents of the file
+        blob (FileBlob): where the contents are kept. blob_id is the hash of the contents, so two
+            files have the same contents exactly when they have the same blob_id. Its index is
+            created by migrations.py, since databases from before blobs lack the column until migrated
+        contents (str): the contents of the file. Loaded from the blob when first used, unless the
+            blob was selected along with the file, and stored when the file is saved
     """
     name = CharField()
-    contents = TextField()
+    blob = ForeignKeyField(FileBlob, index=False)
+
+    @property
+    def contents(self) -> str:
+        if '_contents' not in self.__dict__:
+            self.__dict__['_contents'] = self.blob.text
+        return self.__dict__['_contents']
+
+    @contents.setter
+    def contents(self, value: str):
+        self.__dict__['_contents'] = value
+        self.__dict__['_contents_changed'] = True
+        self.blob_id = FileBlob.hash_of(value)
+
+    def save(self, *args, **kwargs):
+        with DATABASE.atomic():
+            if self.__dict__.pop('_contents_changed', False):
+                FileBlob.store(self.__dict__['_contents'])
+            return super().save(*args, **kwargs)
 MODELS.append(MatlabFile)
 
 class Institution(BaseModel):
@@ -157,7 +252,8 @@ class Submission(BaseModel):
         submittor (Person): the person who made this submission
         submitted_at (datetime): when this submission was uploaded
         graded_at (datetime): when this submission was graded or NULL if not graded yet
-        report (str): the report that was generated while grading this submission
+        report (str): the report that was generated while grading this submission or None. Kept in
+            SubmissionReport, loaded when first used and stored when the submission is saved
 
         submission_entry_file (MatlabFile): the file that is run to begin this submission
     """
@@ -165,11 +261,58 @@ class Submission(BaseModel):
     submittor = ForeignKeyField(Person)
     submitted_at = DateTimeField()
     graded_at = DateTimeField(null=True, default=None)
-    report = TextField(null=True, default=None)
 
     submission_entry_file = ForeignKeyField(MatlabFile)
+
+    @property
+    def report(self) -> str:
+        if '_report' not in self.__dict__:
+            stored = None if self.id is None else SubmissionReport.get_or_none(SubmissionReport.submission == self.id)
+            self.__dict__['_report'] = None if stored is None else stored.text
+        return self.__dict__['_report']
+
+    @report.setter
+    def report(self, value: str):
+        self.__dict__['_report'] = value
+        self.__dict__['_report_changed'] = True
+
+    def save(self, *args, **kwargs):
+        with DATABASE.atomic():
+            result = super().save(*args, **kwargs)
+            if self.__dict__.pop('_report_changed', False):
+                SubmissionReport.store(self.id, self.__dict__['_report'])
+        return result
 MODELS.append(Submission)
 
+class SubmissionReport(BaseModel):
+    """The report that was generated while grading a submission. Kept apart from the submission so
+    that loading submissions does not load their reports, and compressed since reports are mostly
+    repetitive text
+
+    Attributes:
+        submission (Submission): the submission the report is for
+        size (int): the length of the report in bytes before compression
+        data (bytes): the report as zlib compressed utf-8
+    """
+    submission = ForeignKeyField(Submission, primary_key=True, backref='+', on_delete='CASCADE')
+    size = IntegerField()
+    data = BlobField()
+
+    @property
+    def text(self) -> str:
+        """The report, decompressed"""
+        return zlib.decompress(self.data).decode('utf-8')
+
+    @classmethod
+    def store(cls, submission_id: int, text: str):
+        """Replaces the report for the submission with the given id, or removes it if text is None"""
+        if text is None:
+            cls.delete().where(cls.submission == submission_id).execute()
+            return
+        data = text.encode('utf-8')
+        cls.insert(submission=submission_id, size=len(data), data=zlib.compress(data)).on_conflict_replace().execute()
+MODELS.append(SubmissionReport)
+
 class SubmissionAuxilaryFiles(BaseModel):
     """Connects a submission with auxilary files that are required to run it.
 
@@ -182,7 +325,8 @@ class SubmissionAuxilaryFiles(BaseModel):
 MODELS.append(SubmissionAuxilaryFiles)
 
 class SubmissionProblem(BaseModel):
-    """The submission for a particular problem as a part of a submission for an assignment
+    """The submission for a particular problem as a part of a submission for an assignment. There
+    is at most one per submission and problem, which a unique index created by migrations.py enforces
 
     Attributes:
         submission (Submission): the submission this was a part of
@@ -196,5 +340,17 @@ class SubmissionProblem(BaseModel):
     points = FloatField(null=True, default=None)
 MODELS.append(SubmissionProblem)
 
+class GradingMemo(BaseModel):
+    """Remembers which submission was last graded with a particular set of inputs, so that
+    submissions with identical inputs can copy its results rather than being run again
+
+    Attributes:
+        key (str): the hash of every input to grading, see plans.GradingPlan.memo_key
+        submission (Submission): the submission that was graded with those inputs
+    """
+    key = CharField(unique=True)
+    submission = ForeignKeyField(Submission, backref='memos', on_delete='CASCADE')
+MODELS.append(GradingMemo)
+
 DATABASE.connect()
 DATABASE.create_tables(MODELS)
@@ -0,0 +1,244 @@
+"""Loads everything needed to grade submissions up front, in a fixed number of queries, rather than
+lazily walking relations while grading. The part of a plan which only depends on the assignment is
+shared between submissions to the same assignment, and is reused for as long as a fingerprint of
+its files and problems, checked with one query per batch of plans, stays the same."""
+
+import hashlib
+import threading
+
+from models import *
+
+_FINGERPRINT_SQL = '''
+SELECT assignment.id, 'assignment', assignment.assignment_verification_entry_file_id, matlabfile.name, matlabfile.blob_id
+FROM assignment LEFT JOIN matlabfile ON matlabfile.id = assignment.assignment_verification_entry_file_id
+WHERE assignment.id IN ({ids})
+UNION ALL
+SELECT assignment_id, 'produced', id, filename, NULL FROM assignmentproducedfile WHERE assignment_id IN ({ids})
+UNION ALL
+SELECT verfile.problem_id, 'auxilary', verfile.id, matlabfile.name, matlabfile.blob_id
+FROM assignmentauxilaryverificationfiles AS verfile JOIN matlabfile ON matlabfile.id = verfile.auxfile_id
+WHERE verfile.problem_id IN ({ids})
+UNION ALL
+SELECT problem.assignment_id, 'problem', problem.id || ':' || problem.points_out_of, matlabfile.name, matlabfile.blob_id
+FROM problem JOIN matlabfile ON matlabfile.id = problem.verification_entry_file_id
+WHERE problem.assignment_id IN ({ids})
+UNION ALL
+SELECT problem.assignment_id, 'problem auxilary', verfile.problem_id || ':' || verfile.id, matlabfile.name, matlabfile.blob_id
+FROM problemauxilaryverificationfiles AS verfile JOIN problem ON problem.id = verfile.problem_id
+JOIN matlabfile ON matlabfile.id = verfile.auxfile_id
+WHERE problem.assignment_id IN ({ids})
+ORDER BY 1, 2, 3
+'''
+
+class ProblemPlan:
+    """What is needed to verify one problem
+
+    Attributes:
+        problem (Problem): the problem
+        verification_entry_file (MatlabFile): the file that is run to verify the problem
+        auxilary_files (list[MatlabFile]): the additional files needed to verify the problem
+    """
+    def __init__(self, problem: Problem, verification_entry_file: MatlabFile):
+        self.problem = problem
+        self.verification_entry_file = verification_entry_file
+        self.auxilary_files = []
+
+class AssignmentPlan:
+    """The part of grading that is the same for every submission to an assignment
+
+    Attributes:
+        assignment (Assignment): the assignment
+        produced_files (list[str]): the names of the files that submissions must produce
+        verification_entry_file (MatlabFile): the file run before verifying problems or None
+        auxilary_files (list[MatlabFile]): the additional files needed to verify the assignment
+        problems (list[ProblemPlan]): the problems in the assignment, ordered by id
+        fingerprint (str): identifies the assignment's files and problems when this plan was loaded,
+            see _fingerprints
+    """
+    def __init__(self, assignment: Assignment, verification_entry_file: MatlabFile):
+        self.assignment = assignment
+        self.produced_files = []
+        self.verification_entry_file = verification_entry_file
+        self.auxilary_files = []
+        self.problems = []
+        self.fingerprint = None
+        self._memo_key = None
+
+    def memo_key(self) -> str:
+        """Gets a hash of everything about this assignment which affects grading: the produced
+        files, the verification files, and each problem's id, points and verification files"""
+        if self._memo_key is None:
+            digest = hashlib.sha256()
+            _hash_files(digest, [self.verification_entry_file] if self.verification_entry_file else [])
+            _hash_files(digest, self.auxilary_files)
+            digest.update(repr(self.produced_files).encode('utf-8'))
+            for problem_plan in self.problems:
+                digest.update(repr((problem_plan.problem.id, problem_plan.problem.points_out_of)).encode('utf-8'))
+                _hash_files(digest, [problem_plan.verification_entry_file])
+                _hash_files(digest, problem_plan.auxilary_files)
+            self._memo_key = digest.hexdigest()
+        return self._memo_key
+
+class GradingPlan:
+    """Everything needed to grade a submission
+
+    Attributes:
+        submission (Submission): the submission
+        submittor_name (str): the name of the person who made the submission
+        entry_file (MatlabFile): the file that is run to begin the submission
+        auxilary_files (list[MatlabFile]): the additional files needed to run the submission
+        assignment (AssignmentPlan): the plan for the assignment the submission is for
+        submission_problems (dict[int, SubmissionProblem]): the existing results for this submission
+            by problem id
+    """
+    def __init__(self, submission: Submission, assignment: AssignmentPlan):
+        self.submission = submission
+        self.submittor_name = submission.submittor.name
+        self.entry_file = submission.submission_entry_file
+        self.auxilary_files = []
+        self.assignment = assignment
+        self.submission_problems = {}
+
+    def memo_key(self) -> str:
+        """Gets a hash of every input to grading this submission. Two submissions with the same
+        key to the same assignment get the same results, barring timeouts"""
+        digest = hashlib.sha256(self.assignment.memo_key().encode('utf-8'))
+        _hash_files(digest, [self.entry_file])
+        _hash_files(digest, self.auxilary_files)
+        return digest.hexdigest()
+
+def _hash_files(digest, files):
+    digest.update(f'{len(files)}\0'.encode('utf-8'))
+    for mfile in files:
+        digest.update(f'{mfile.name}\0{mfile.blob_id}\0'.encode('utf-8'))
+
+_ASSIGNMENT_PLANS = {}
+_ASSIGNMENT_PLANS_LOCK = threading.Lock()
+
+def invalidate(assignment_id: int = None):
+    """Forgets the cached plan for the assignment with the given id, or for every assignment if
+    the id is None, so that the next plan which needs it loads it again"""
+    with _ASSIGNMENT_PLANS_LOCK:
+        if assignment_id is None:
+            _ASSIGNMENT_PLANS.clear()
+        else:
+            _ASSIGNMENT_PLANS.pop(assignment_id, None)
+
+def _fingerprints(assignment_ids) -> dict:
+    """Gets a hash of the rows which make up each of the given assignments' plans, including the
+    blob of every verification file, so that a changed file or problem changes the hash
+
+    Returns:
+        dict[int, str]: the fingerprints by assignment id
+    """
+    digests = {assignment_id: hashlib.sha256() for assignment_id in assignment_ids}
+    ids = ', '.join('?' * len(assignment_ids))
+    for row in DATABASE.execute_sql(_FINGERPRINT_SQL.format(ids=ids), list(assignment_ids) * 5):
+        digests[row[0]].update(repr(row[1:]).encode('utf-8'))
+    return {assignment_id: digest.hexdigest() for assignment_id, digest in digests.items()}
+
+def _load_assignment_plans(assignment_ids) -> dict:
+    plans = {}
+    query = (Assignment.select(Assignment, MatlabFile)
+             .join(MatlabFile, JOIN.LEFT_OUTER, on=Assignment.assignment_verification_entry_file)
+             .where(Assignment.id.in_(assignment_ids)))
+    for assignment in query:
+        entry_file = assignment.assignment_verification_entry_file if assignment.assignment_verification_entry_file_id else None
+        plans[assignment.id] = AssignmentPlan(assignment, entry_file)
+
+    for prod_file in (AssignmentProducedFile.select()
+                      .where(AssignmentProducedFile.assignment.in_(assignment_ids))
+                      .order_by(AssignmentProducedFile.id)):
+        plans[prod_file.assignment_id].produced_files.append(prod_file.filename)
+
+    for verfile in (AssignmentAuxilaryVerificationFiles.select(AssignmentAuxilaryVerificationFiles, MatlabFile)
+                    .join(MatlabFile)
+                    .where(AssignmentAuxilaryVerificationFiles.problem.in_(assignment_ids))
+                    .order_by(AssignmentAuxilaryVerificationFiles.id)):
+        plans[verfile.problem_id].auxilary_files.append(verfile.auxfile)
+
+    problems = {}
+    for problem in (Problem.select(Problem, MatlabFile)
+                    .join(MatlabFile)
+                    .where(Problem.assignment.in_(assignment_ids))
+                    .order_by(Problem.id)):
+        problems[problem.id] = ProblemPlan(problem, problem.verification_entry_file)
+        plans[problem.assignment_id].problems.append(problems[problem.id])
+
+    for verfile in (ProblemAuxilaryVerificationFiles.select(ProblemAuxilaryVerificationFiles, MatlabFile)
+                    .join(MatlabFile)
+                    .switch(ProblemAuxilaryVerificationFiles)
+                    .join(Problem)
+                    .where(Problem.assignment.in_(assignment_ids))
+                    .order_by(ProblemAuxilaryVerificationFiles.id)):
+        problems[verfile.problem_id].auxilary_files.append(verfile.auxfile)
+    return plans
+
+def _assignment_plans(assignment_ids) -> dict:
+    if not assignment_ids:
+        return {}
+    fingerprints = _fingerprints(assignment_ids)
+    plans = {}
+    with _ASSIGNMENT_PLANS_LOCK:
+        for assignment_id in assignment_ids:
+            plan = _ASSIGNMENT_PLANS.get(assignment_id)
+            if plan is not None and plan.fingerprint == fingerprints[assignment_id]:
+                plans[assignment_id] = plan
+
+    missing = [assignment_id for assignment_id in assignment_ids if assignment_id not in plans]
+    if missing:
+        loaded = _load_assignment_plans(missing)
+        for assignment_id, plan in loaded.items():
+            plan.fingerprint = fingerprints[assignment_id]
+        with _ASSIGNMENT_PLANS_LOCK:
+            _ASSIGNMENT_PLANS.update(loaded)
+        plans.update(loaded)
+    return plans
+
+def load_plans(submission_ids) -> dict:
+    """Loads the grading plans for the submissions with the given ids. Takes four queries, plus
+    five more if any of the assignments are not cached or have changed since they were cached, no
+    matter how many submissions there are.
+    The contents of submission files are loaded with them, while the contents of verification
+    files are only loaded if they are needed to build a tree in the FileTreeCache. Ids of
+    submissions which do not exist are skipped.
+
+    Returns:
+        dict[int, GradingPlan]: the plans by submission id
+    """
+    submission_ids = list(set(submission_ids))
+    if not submission_ids:
+        return {}
+
+    submissions = list(Submission.select(Submission, Person, MatlabFile, FileBlob)
+                       .join(Person, on=Submission.submittor)
+                       .switch(Submission)
+                       .join(MatlabFile, on=Submission.submission_entry_file)
+                       .join(FileBlob)
+                       .where(Submission.id.in_(submission_ids)))
+    assignments = _assignment_plans(list({submission.assignment_id for submission in submissions}))
+    plans = {}
+    for submission in submissions:
+        plans[submission.id] = GradingPlan(submission, assignments[submission.assignment_id])
+
+    for auxfile in (SubmissionAuxilaryFiles.select(SubmissionAuxilaryFiles, MatlabFile, FileBlob)
+                    .join(MatlabFile)
+                    .join(FileBlob)
+                    .where(SubmissionAuxilaryFiles.submission.in_(submission_ids))
+                    .order_by(SubmissionAuxilaryFiles.id)):
+        plans[auxfile.submission_id].auxilary_files.append(auxfile.auxfile)
+
+    for subm_problem in SubmissionProblem.select().where(SubmissionProblem.submission.in_(submission_ids)):
+        plans[subm_problem.submission_id].submission_problems.setdefault(subm_problem.problem_id, subm_problem)
+    return plans
+
+def load_plan(submission_id: int) -> GradingPlan:
+    """Loads the grading plan for the submission with the given id
+
+    Raises:
+        Submission.DoesNotExist: if there is no such submission
+    """
+    plan = load_plans([submission_id]).get(submission_id)
+    if plan is None:
+        raise Submission.DoesNotExist(f'no submission with id {submission_id}')
+    return plan
@@ -0,0 +1,163 @@
+"""Allows grading several submissions at once by keeping a pool of engines, each of which
+is used by one worker thread at a time and owns its own working directory"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import threading
+import time
+import logging
+
+from engines import MatlabEngine
+import metrics
+
+LOG = logging.getLogger(__name__)
+
+ENGINE_BUSY_SECONDS = metrics.Counter('matlab_evaluator_engine_busy_seconds', 'Seconds each engine spent in calls', ('engine',))
+ENGINE_RESTARTS = metrics.Counter('matlab_evaluator_engine_restarts', 'Times each engine was recycled', ('engine',))
+ENGINES_BUSY = metrics.Gauge('matlab_evaluator_engines_busy', 'Engines currently in a call')
+
+SCRATCH_DIRS = ['/dev/shm']
+"""The memory backed folders which temporary folders are created in if one is available, since
+grading writes and removes many small files"""
+
+def scratch_dir() -> str:
+    """Gets the folder temporary folders for grading should be created in: the folder in the
+    MATLAB_EVALUATOR_SCRATCH environment variable if it is set (such as a disk backed folder if
+    submissions write large files), otherwise the first of SCRATCH_DIRS which exists and is
+    writable, or None for the default temporary folder"""
+    if os.environ.get('MATLAB_EVALUATOR_SCRATCH'):
+        return os.environ['MATLAB_EVALUATOR_SCRATCH']
+    for path in SCRATCH_DIRS:
+        if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    return None
+
+class EnginePool:
+    """A fixed number of engines which functions can be submitted to. Each submitted function
+    is called with an engine that nothing else is using for the duration of the call. Engines
+    can be recycled (restarted) after a number of calls or once they use too much memory, so
+    that slow leaks in long grading runs do not accumulate. Calls can be given an affinity (such
+    as an assignment id) so that they prefer an idle engine whose last call had the same affinity.
+
+    Attributes:
+        workers (int): the number of engines (and threads) in this pool
+        rootdir (str): the folder which contains the working directory for each engine. If not
+            given, a temporary folder in scratch_dir() which is removed when the pool is closed
+        max_jobs (int): the number of calls after which an engine is restarted, or None
+        max_memory (int): the number of bytes of memory after which an engine is restarted, or None
+        engines (list[Engine]): every engine in this pool
+        jobs (dict[Engine, int]): the number of calls each engine has handled since it was restarted
+        executor (ThreadPoolExecutor): the threads that call submitted functions
+        affinities (dict[Engine, any]): the affinity of the last call each engine handled since it was
+            restarted, or None
+        idle (list[Engine]): the engines which are not currently in use, least recently used first
+    """
+    def __init__(self, workers: int, engine_factory=MatlabEngine, rootdir: str = None, max_jobs: int = None,
+                 max_memory: int = None):
+        if workers < 1:
+            raise ValueError(f'expected at least one worker but got {workers}')
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self._owns_rootdir = rootdir is None
+        self.rootdir = tempfile.mkdtemp(prefix='matlab-evaluator-', dir=scratch_dir()) if rootdir is None else rootdir
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='grader')
+        self.idle = []
+        self._idle_changed = threading.Condition()
+
+        def create(index):
+            workdir = os.path.join(self.rootdir, f'worker{index}')
+            os.makedirs(workdir, exist_ok=True)
+            engine = engine_factory(workdir=workdir)
+            engine.start()
+            return engine
+
+        LOG.info('Starting %s engines', workers)
+        starttime = time.time()
+        self.engines = list(self.executor.map(create, range(workers)))
+        LOG.info('Started %s engines in %.1fs', workers, time.time() - starttime)
+        self.jobs = dict((engine, 0) for engine in self.engines)
+        self.affinities = dict((engine, None) for engine in self.engines)
+        self.idle.extend(self.engines)
+
+    def _recycle_if_needed(self, engine):
+        self.jobs[engine] += 1
+        reason = None
+        if self.max_jobs is not None and self.jobs[engine] >= self.max_jobs:
+            reason = f'after {self.jobs[engine]} jobs'
+        elif self.max_memory is not None:
+            memory = engine.memory_usage()
+            if memory is not None and memory > self.max_memory:
+                reason = f'using {memory / 2**20:.0f}MB'
+        if reason is None:
+            return
+
+        LOG.info('Recycling engine in %s %s', engine.workdir, reason)
+        ENGINE_RESTARTS.inc(engine=os.path.basename(engine.workdir))
+        self.jobs[engine] = 0
+        self.affinities[engine] = None
+        try:
+            engine.restart()
+        except: # pylint: disable=bare-except
+            LOG.error('Failed to restart engine in %s', engine.workdir, exc_info=1)
+
+    def _checkout(self, affinity):
+        with self._idle_changed:
+            while not self.idle:
+                self._idle_changed.wait()
+            engine = self.idle[0]
+            if affinity is not None:
+                engine = next((other for other in self.idle if self.affinities[other] == affinity), engine)
+            self.idle.remove(engine)
+            return engine
+
+    def _checkin(self, engine):
+        with self._idle_changed:
+            self.idle.append(engine)
+            self._idle_changed.notify()
+
+    def _call(self, func, args, affinity):
+        engine = self._checkout(affinity)
+        ENGINES_BUSY.inc()
+        starttime = time.perf_counter()
+        try:
+            return func(engine, *args)
+        finally:
+            ENGINE_BUSY_SECONDS.inc(time.perf_counter() - starttime, engine=os.path.basename(engine.workdir))
+            ENGINES_BUSY.inc(-1)
+            self.affinities[engine] = affinity
+            self._recycle_if_needed(engine)
+            self._checkin(engine)
+
+    def idle_affinities(self) -> set:
+        """Gets the affinities of the last calls handled by the engines which are currently idle"""
+        with self._idle_changed:
+            return set(self.affinities[engine] for engine in self.idle) - {None}
+
+    def submit(self, func, *args, affinity=None):
+        """Calls func(engine, *args) on an idle engine in the background, preferring an engine
+        whose last call had the same affinity if affinity is not None
+
+        Returns:
+            a concurrent.futures.Future for the result of the call
+        """
+        return self.executor.submit(self._call, func, args, affinity)
+
+    def close(self):
+        """Waits for submitted functions to complete then stops every engine"""
+        self.executor.shutdown(wait=True)
+        for engine in self.engines:
+            try:
+                engine.quit()
+            except: # pylint: disable=bare-except
+                LOG.warning('Failed to quit engine', exc_info=1)
+        if self._owns_rootdir:
+            shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
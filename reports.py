@@ -0,0 +1,96 @@
+"""Keeps the reports written while grading to a bounded size. A script which prints in a loop can
+write hundreds of megabytes, so rather than holding everything in memory and in the database only
+the beginning and end of each stream are kept, along with how much was left out."""
+
+import collections
+import io
+
+MAX_REPORT_BYTES = 1 << 20
+"""The most bytes of a grading report that are kept"""
+
+MAX_OUTPUT_BYTES = 256 << 10
+"""The most bytes of a single script's stdout or stderr that are kept"""
+
+def _complete_prefix(data) -> int:
+    """Gets the length of the longest prefix of the given utf-8 which does not end part way
+    through a character"""
+    start = len(data)
+    while start > 0 and len(data) - start < 4 and data[start - 1] & 0xC0 == 0x80:
+        start -= 1
+    if start == 0:
+        return 0
+    lead = data[start - 1]
+    size = 1 if lead < 0x80 else 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+    return len(data) if start - 1 + size <= len(data) else start - 1
+
+def _partial_prefix(data) -> int:
+    """Gets the number of bytes at the start of the given utf-8 which are the end of a character
+    that was cut off"""
+    skip = 0
+    while skip < min(len(data), 3) and data[skip] & 0xC0 == 0x80:
+        skip += 1
+    return skip
+
+class BoundedReport(io.TextIOBase):
+    """A text stream which keeps at most max_bytes of what is written to it: the first half, and
+    the last half as it is written. Can be given to engines in place of an io.StringIO.
+
+    Attributes:
+        max_bytes (int): the most bytes of utf-8 that are kept
+        written (int): the number of bytes that have been written in total
+    """
+    def __init__(self, max_bytes: int = MAX_REPORT_BYTES):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.written = 0
+        self._head_limit = max_bytes // 2
+        self._tail_limit = max_bytes - self._head_limit
+        self._head = bytearray()
+        self._tail = collections.deque()
+        self._tail_size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        data = text.encode('utf-8')
+        self.written += len(data)
+        room = self._head_limit - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        if not data or self._tail_limit <= 0:
+            return len(text)
+
+        if len(data) >= self._tail_limit:
+            self._tail.clear()
+            self._tail.append(data[-self._tail_limit:])
+            self._tail_size = self._tail_limit
+            return len(text)
+        self._tail.append(data)
+        self._tail_size += len(data)
+        while self._tail_size > self._tail_limit:
+            excess = self._tail_size - self._tail_limit
+            if len(self._tail[0]) <= excess:
+                self._tail_size -= len(self._tail.popleft())
+            else:
+                self._tail[0] = self._tail[0][excess:]
+                self._tail_size -= excess
+        return len(text)
+
+    @property
+    def omitted(self) -> int:
+        """The number of bytes written which are not kept"""
+        return self.written - len(self._head) - self._tail_size
+
+    def getvalue(self) -> str:
+        """Gets what was kept, with a note of how many bytes were left out in the middle if any were.
+        Characters which were only partly kept are left out too"""
+        head = bytes(self._head)
+        tail = b''.join(self._tail)
+        if not self.omitted:
+            return (head + tail).decode('utf-8')
+        head = head[:_complete_prefix(head)]
+        tail = tail[_partial_prefix(tail):]
+        omitted = self.written - len(head) - len(tail)
+        return f'{head.decode("utf-8")}\n... {omitted} bytes omitted ...\n{tail.decode("utf-8")}'
@@ -0,0 +1,158 @@
+"""Decides which queued job is graded next. Jobs are read ahead from the input queue (they stay
+unacked there until graded, so nothing is lost if the grader dies) and are then handed out by
+priority, preferring jobs for assignments that an idle engine graded last so that per-engine state
+such as warm setups is reused. Submissions queued more than once are only graded once."""
+
+import itertools
+import logging
+
+from models import Submission
+
+LOG = logging.getLogger(__name__)
+
+PRIORITY_REGRADE = 0
+"""The default priority of a job for a submission that has been graded before"""
+
+PRIORITY_NEW = 10
+"""The default priority of a job for a submission that has not been graded yet"""
+
+class ScheduledJob:
+    """One submission to grade, which may have been queued several times
+
+    Attributes:
+        data (any): what to grade; the submission id for valid jobs, otherwise the queued item
+        submission_id (int): the id of the submission to grade or None if the item was invalid
+        assignment_id (int): the id of the assignment the submission is for or None if unknown
+        priority (int): jobs with higher priorities are graded first
+        items (list[dict]): the raw queue items (with 'pqid' and 'data') this job will complete
+        order (int): when this job was first read from the queue, for first-in-first-out within a priority
+    """
+    def __init__(self, data, submission_id: int, priority: int, order: int):
+        self.data = data
+        self.submission_id = submission_id
+        self.assignment_id = None
+        self.priority = priority
+        self.items = []
+        self.order = order
+
+def _parse_item(data):
+    """Gets the submission id and explicit priority (or None) from a queued item. Items are either
+    a submission id or a dict like {'submission': 3, 'priority': 5}"""
+    if isinstance(data, dict) and isinstance(data.get('submission'), int):
+        priority = data.get('priority')
+        return data['submission'], priority if isinstance(priority, int) else None
+    if isinstance(data, int) and not isinstance(data, bool):
+        return data, None
+    return None, None
+
+class Scheduler:
+    """Reads jobs ahead from a broker and hands them out in order of priority, then
+    assignment affinity, then age. A submission is never handed out while it is already being
+    graded; duplicates queued before grading starts are coalesced into the same job.
+
+    Attributes:
+        jobque (broker.Broker): where jobs are read from
+        lookahead (int): the most jobs which are read ahead of being graded
+        buffered (dict[any, ScheduledJob]): the jobs which have been read but not handed out, by key
+        running (set[int]): the ids of the submissions which have been handed out but not finished
+    """
+    def __init__(self, jobque, lookahead: int = 256):
+        self.jobque = jobque
+        self.lookahead = max(lookahead, 1)
+        self.buffered = {}
+        self.running = set()
+        self._counter = itertools.count()
+
+    def fill(self, timeout: float = 0) -> int:
+        """Reads jobs from the queue until lookahead jobs are buffered or the queue is empty,
+        waiting up to timeout seconds for the first if there are none
+
+        Returns:
+            the number of items read
+        """
+        total = self._read(timeout)
+        if total:
+            while True:
+                read = self._read(0)
+                if not read:
+                    break
+                total += read
+        return total
+
+    def _read(self, timeout: float) -> int:
+        """Reads as many items as there is room for in one batch, since duplicates may leave room for more"""
+        room = self.lookahead - len(self.buffered)
+        if room <= 0:
+            return 0
+        items = self.jobque.get_batch(room, timeout=timeout)
+        if not items:
+            return 0
+
+        new_jobs = []
+        for item in items:
+            submission_id, priority = _parse_item(item['data'])
+            key = ('invalid', item['pqid']) if submission_id is None else submission_id
+            job = self.buffered.get(key)
+            if job is None:
+                job = ScheduledJob(item['data'] if submission_id is None else submission_id, submission_id,
+                                   priority, next(self._counter))
+                self.buffered[key] = job
+                new_jobs.append(job)
+            elif priority is not None:
+                job.priority = priority if job.priority is None else max(job.priority, priority)
+            if job.items:
+                LOG.debug('Coalescing duplicate job for submission %s', submission_id)
+            job.items.append(item)
+
+        ids = [job.submission_id for job in new_jobs if job.submission_id is not None]
+        found = {}
+        if ids:
+            query = (Submission.select(Submission.id, Submission.assignment, Submission.graded_at)
+                     .where(Submission.id.in_(ids)))
+            found = {submission.id: submission for submission in query}
+        for job in new_jobs:
+            submission = found.get(job.submission_id)
+            if submission is not None:
+                job.assignment_id = submission.assignment_id
+            if job.priority is None:
+                job.priority = PRIORITY_REGRADE if submission is not None and submission.graded_at is not None else PRIORITY_NEW
+        return len(items)
+
+    def take(self, affinities=()) -> ScheduledJob:
+        """Hands out the next job to grade, or None if there are none which can be graded now.
+        Among the jobs with the highest priority, the oldest for an assignment in affinities is
+        preferred, and otherwise the oldest.
+
+        Args:
+            affinities (set[int]): the assignment ids the idle engines graded last
+        """
+        best = None
+        best_key = None
+        for job in self.buffered.values():
+            if job.submission_id is not None and job.submission_id in self.running:
+                continue
+            preferred = job.assignment_id is not None and job.assignment_id in affinities
+            key = (-job.priority, not preferred, job.order)
+            if best_key is None or key < best_key:
+                best, best_key = job, key
+        if best is None:
+            return None
+
+        del self.buffered[best.submission_id if best.submission_id is not None else ('invalid', best.items[0]['pqid'])]
+        if best.submission_id is not None:
+            self.running.add(best.submission_id)
+        return best
+
+    def finished(self, job: ScheduledJob):
+        """Marks a job handed out by take as no longer being graded"""
+        self.running.discard(job.submission_id)
+
+    def drain(self) -> list:
+        """Removes every job which has not been handed out yet
+
+        Returns:
+            list[dict]: the raw queue items of the removed jobs, which should be nacked
+        """
+        items = [item for job in self.buffered.values() for item in job.items]
+        self.buffered.clear()
+        return items
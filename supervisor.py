@@ -0,0 +1,293 @@
+"""Runs engines in child processes so that a script which is stuck or leaking memory can be dealt
+with by killing the process, rather than degrading the engine for every later submission"""
+
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import threading
+import time
+
+from engines import Engine
+from reports import MAX_OUTPUT_BYTES, BoundedReport
+
+LOG = logging.getLogger(__name__)
+
+class EngineCrashedError(Exception):
+    """Raised when the process running an engine dies or stops responding"""
+
+class RemoteEngineError(Exception):
+    """Raised when the engine in a child process raises an error. The message includes the type
+    and message of the original error"""
+
+def _describe(exc):
+    return f'{type(exc).__name__}: {exc}'
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception: # pylint: disable=broad-except
+        return float(value)
+
+def _report_run(future, stdout, stderr, send):
+    future.wait()
+    error = None
+    value = None
+    if not future.cancelled():
+        try:
+            value = future.result()
+        except Exception as exc: # pylint: disable=broad-except
+            error = _describe(exc)
+    send(('done', stdout.getvalue(), stderr.getvalue(), future.cancelled(), error, value))
+
+_COMMANDS = {'start': 'start', 'cd': 'cd', 'get': 'get_variable', 'clear': 'clear_workspace',
+             'save': 'save_workspace', 'load': 'load_workspace'}
+
+def _serve(conn, engine_factory, workdir):
+    """The main loop of the child process, which answers requests from the ProcessEngine"""
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    engine = engine_factory(workdir=workdir)
+    send_lock = threading.Lock()
+    running = None
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        command, args = message[0], message[1:]
+        if command == 'cancel':
+            if running is not None:
+                running.cancel()
+            continue
+        if command in ('run', 'batch'):
+            stdout, stderr = BoundedReport(MAX_OUTPUT_BYTES), BoundedReport(MAX_OUTPUT_BYTES)
+            try:
+                if command == 'run':
+                    running = engine.run(args[0], stdout, stderr)
+                else:
+                    running = engine.run_batch(args[0], args[1], stdout, stderr)
+            except Exception as exc: # pylint: disable=broad-except
+                send(('done', '', '', False, _describe(exc), None))
+                continue
+            threading.Thread(target=_report_run, args=(running, stdout, stderr, send), daemon=True).start()
+            continue
+        try:
+            if command == 'quit':
+                engine.quit()
+                send(('ok', None))
+                break
+            send(('ok', _picklable(getattr(engine, _COMMANDS[command])(*args))))
+        except Exception as exc: # pylint: disable=broad-except
+            send(('error', _describe(exc)))
+
+def _tree_memory_usage(pid):
+    """Gets the resident memory of the process with the given pid and all of its descendants, in
+    bytes, or None if it cannot be determined on this platform"""
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as infile:
+                stat = infile.read()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    todo = [pid]
+    while todo:
+        current = todo.pop()
+        todo.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/statm', 'r') as infile:
+                total += int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            continue
+    return total
+
+class _ProcessFuture:
+    """The result of running a script on a ProcessEngine. Cancelling it asks the child to cancel
+    the script and kills the child if it has not done so within the engine's kill_after seconds"""
+    def __init__(self, engine, stdout, stderr):
+        self.engine = engine
+        self.stdout = stdout
+        self.stderr = stderr
+        self._finished = False
+        self._cancelled = False
+        self._error = None
+        self._value = None
+
+    def _receive(self, timeout):
+        if self._finished:
+            return True
+        conn = self.engine._conn # pylint: disable=protected-access
+        try:
+            if not conn.poll(timeout):
+                return False
+            _, stdout, stderr, cancelled, error, self._value = conn.recv()
+        except (EOFError, OSError):
+            self.engine.kill()
+            self._error = EngineCrashedError('the engine process died while running a script')
+        else:
+            self.stdout.write(stdout)
+            self.stderr.write(stderr)
+            self._cancelled = cancelled
+            if error is not None:
+                self._error = RemoteEngineError(error)
+        self._finished = True
+        return True
+
+    def done(self) -> bool:
+        return self._receive(0)
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._receive(timeout)
+
+    def cancel(self) -> bool:
+        if self._finished:
+            return self._cancelled
+        try:
+            self.engine._conn.send(('cancel',)) # pylint: disable=protected-access
+        except OSError:
+            pass
+        if not self._receive(self.engine.kill_after):
+            LOG.warning('Engine did not stop within %ss of being cancelled - killing it', self.engine.kill_after)
+            self.engine.kill()
+            self._finished = True
+            self._cancelled = True
+        return self._cancelled
+
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def result(self, timeout: float = None):
+        if not self.wait(timeout):
+            raise TimeoutError('timed out waiting for the engine process')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class ProcessEngine(Engine):
+    """An engine which runs another engine in a child process. The child is started when the engine
+    is first used and started again after it is killed, so a stuck script costs one restart rather
+    than the engine. Killing the child kills everything it started, such as the matlab process.
+
+    Attributes:
+        engine_factory (callable): creates the engine in the child; called with the workdir keyword
+            argument. Must be picklable
+        kill_after (float): how long a cancelled script has to stop before the child is killed
+        call_timeout (float): how long any other request may take before the child is killed
+        process (multiprocessing.Process): the child process, or None if not running
+    """
+    def __init__(self, engine_factory, workdir: str = None, kill_after: float = 5.0, call_timeout: float = 300.0):
+        super().__init__(workdir)
+        self.engine_factory = engine_factory
+        self.kill_after = kill_after
+        self.call_timeout = call_timeout
+        self.process = None
+        self._conn = None
+
+    def start(self) -> float:
+        if self.process is not None and self.process.is_alive():
+            return 0.0
+        self.kill()
+        starttime = time.time()
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn, self.engine_factory, self.workdir),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self._call('start')
+        return time.time() - starttime
+
+    def _call(self, command, *args):
+        if self.process is None and command != 'quit':
+            self.start()
+        try:
+            self._conn.send((command,) + args)
+            if not self._conn.poll(self.call_timeout):
+                raise EngineCrashedError(f'the engine process did not respond to {command} within {self.call_timeout}s')
+            status, value = self._conn.recv()
+        except (EOFError, OSError) as exc:
+            self.kill()
+            raise EngineCrashedError(f'the engine process died during {command}') from exc
+        except EngineCrashedError:
+            self.kill()
+            raise
+        if status == 'error':
+            raise RemoteEngineError(value)
+        return value
+
+    def cd(self, path: str) -> str:
+        return self._call('cd', path)
+
+    def _start_run(self, message, stdout, stderr):
+        if self.process is None:
+            self.start()
+        try:
+            self._conn.send(message)
+        except OSError as exc:
+            self.kill()
+            raise EngineCrashedError('the engine process died before running a script') from exc
+        return _ProcessFuture(self, stdout, stderr)
+
+    def run(self, name: str, stdout, stderr):
+        return self._start_run(('run', name), stdout, stderr)
+
+    def run_batch(self, names, variable: str, stdout, stderr):
+        return self._start_run(('batch', list(names), variable), stdout, stderr)
+
+    def get_variable(self, name: str):
+        return self._call('get', name)
+
+    def clear_workspace(self):
+        self._call('clear')
+
+    def save_workspace(self, path: str):
+        self._call('save', path)
+
+    def load_workspace(self, path: str):
+        self._call('load', path)
+
+    def memory_usage(self) -> int:
+        if self.process is None:
+            return 0
+        return _tree_memory_usage(self.process.pid)
+
+    def kill(self):
+        """Kills the child process and everything it started, if it is running"""
+        if self.process is None:
+            return
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.kill()
+        self.process.join()
+        self._conn.close()
+        self.process = None
+        self._conn = None
+
+    def quit(self):
+        if self.process is None:
+            return
+        try:
+            self._call('quit')
+            self.process.join(self.kill_after)
+        except (EngineCrashedError, RemoteEngineError):
+            LOG.warning('Engine process did not quit cleanly', exc_info=1)
+        self.kill()
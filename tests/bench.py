@@ -0,0 +1,22 @@
+"""Tests the helpers the benchmarks use to generate files and summarise timings. Does not require
+matlab or a database"""
+
+from bench import _pad, percentile
+
+def main():
+    """Runs the test"""
+    padded = _pad('points = 5;', 1000)
+    assert len(padded) == 1000 and padded.startswith('points = 5;\n'), padded
+    assert all(line.startswith('%') for line in padded.splitlines()[1:]), padded
+    assert _pad('points = 5;', 3) == 'points = 5;'
+
+    assert percentile([], 0.5) is None
+    assert percentile([3.0], 0.99) == 3.0
+    values = list(range(100, 0, -1))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile(values, 1.0) == 100
+    print('bench: ok')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Tests that jobs served over the network are leased, redelivered once their lease expires and
+graded by several workers on localhost. Does not require matlab"""
+
+import contextlib
+import io
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+with open('conf/database.json', 'r') as infile:
+    SETTINGS = json.load(infile)
+
+if 'test' not in SETTINGS['file']:
+    raise RuntimeError(f'cannot run test against database without test in the name')
+
+for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(SETTINGS['file'] + suffix):
+        os.remove(SETTINGS['file'] + suffix)
+
+from models import *
+from bench import generate_course
+from broker import BrokerServer, SQLiteBroker, TCPBroker
+
+def _abandon(address, size):
+    """Fetches jobs the way a worker does and then disappears without acking or renewing them"""
+    with socket.create_connection(address) as sock, sock.makefile('rwb') as stream:
+        stream.write(json.dumps({'op': 'get', 'worker': 'crashed', 'size': size, 'timeout': 0}).encode('utf-8') + b'\n')
+        stream.flush()
+        return json.loads(stream.readline())['items']
+
+def _reset(address):
+    """Sends a request the way a worker does and then resets the connection like a killed worker"""
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    sock.sendall(json.dumps({'op': 'depths'}).encode('utf-8') + b'\n')
+    time.sleep(0.1)
+    sock.close()
+
+def main():
+    """Runs the test"""
+    with tempfile.TemporaryDirectory() as folder:
+        local = SQLiteBroker(os.path.join(folder, 'in'), os.path.join(folder, 'out'), multithreading=True)
+        server = BrokerServer(('127.0.0.1', 0), local, lease_time=0.5)
+        server.start()
+        address = f'127.0.0.1:{server.server_address[1]}'
+        try:
+            with TCPBroker(address) as first, TCPBroker(address) as second:
+                first.put_batch(['a', 'b', 'c'])
+                assert first.depths() == {'in': 3, 'out': 0}, first.depths()
+                items = first.get_batch(2, timeout=0)
+                assert [item['data'] for item in items] == ['a', 'b'] and first.held == {item['pqid'] for item in items}
+                assert second.get_batch(5, timeout=0)[0]['data'] == 'c'
+                assert second.get_batch(5, timeout=0.1) == []
+
+                second.ack_batch([items[0]['pqid']], ['stolen'])
+                assert local.depths()['out'] == 0, 'expected an ack for a job held by another worker to be ignored'
+                time.sleep(1.0)
+                assert len(server.leases) == 3, 'expected renewed leases not to expire'
+                first.ack_batch([item['pqid'] for item in items], ['A', 'B'])
+                assert first.held == set() and local.depths() == {'in': 0, 'out': 2}
+                second.nack_batch(list(second.held))
+                again = first.get_batch(5, timeout=0)
+                assert [item['data'] for item in again] == ['c']
+                first.nack_batch([again[0]['pqid']])
+
+            errors = io.StringIO()
+            with contextlib.redirect_stderr(errors):
+                _reset(server.server_address)
+                time.sleep(0.2)
+            assert not errors.getvalue(), errors.getvalue()
+
+            lost = _abandon(server.server_address, 5)
+            assert [item['data'] for item in lost] == ['c'] and not server.expire()
+            time.sleep(0.8)
+            assert not server.leases, 'expected the lease of the abandoned job to expire'
+            with TCPBroker(address) as third:
+                assert third.get_batch(5, timeout=0)[0]['data'] == 'c'
+        finally:
+            server.shutdown()
+
+    submission_ids = generate_course(assignments=2, problems=2, aux_files=1, submissions=10, file_size=200)
+    with tempfile.TemporaryDirectory() as folder:
+        local = SQLiteBroker(os.path.join(folder, 'in'), os.path.join(folder, 'out'), multithreading=True)
+        local.put_batch(submission_ids)
+        server = BrokerServer(('127.0.0.1', 0), local, lease_time=1.0)
+        server.start()
+        address = f'127.0.0.1:{server.server_address[1]}'
+        abandoned = _abandon(server.server_address, 3)
+        workers = [subprocess.Popen([sys.executable, '-m', 'main', '--broker', address, '--engine', 'fake', '--loop',
+                                     '--logging-conf', 'conf/logging.json'], stdout=subprocess.DEVNULL)
+                   for _ in range(3)]
+        try:
+            deadline = time.monotonic() + 60
+            while local.depths()['out'] < len(submission_ids) and time.monotonic() < deadline:
+                time.sleep(0.1)
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.wait()
+            server.shutdown()
+        results = [item['data'] for item in local.outque.get_batch(len(submission_ids) + 1, timeout=0)]
+    assert sorted(results) == sorted(submission_ids), results
+    assert {item['data'] for item in abandoned} <= set(results)
+    assert Submission.select().where(Submission.graded_at.is_null()).count() == 0
+
+    submission_ids = generate_course(assignments=1, problems=1, aux_files=0, submissions=12, file_size=100, script_time=0.1)
+    with tempfile.TemporaryDirectory() as folder:
+        local = SQLiteBroker(os.path.join(folder, 'in'), os.path.join(folder, 'out'), multithreading=True)
+        local.put_batch(submission_ids)
+        server = BrokerServer(('127.0.0.1', 0), local, lease_time=5.0)
+        server.start()
+        address = f'127.0.0.1:{server.server_address[1]}'
+        workers = [subprocess.Popen([sys.executable, '-m', 'main', '--broker', address, '--engine', 'fake', '--loop',
+                                     '--logging-conf', 'conf/logging.json'], stdout=subprocess.DEVNULL)
+                   for _ in range(2)]
+        held = {worker.pid: 0 for worker in workers}
+        try:
+            deadline = time.monotonic() + 60
+            while local.depths()['out'] < len(submission_ids) and time.monotonic() < deadline:
+                for pid in held:
+                    count = sum(1 for holder, _ in list(server.leases.values()) if holder.split(':')[1] == str(pid))
+                    held[pid] = max(held[pid], count)
+                time.sleep(0.02)
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.wait()
+            server.shutdown()
+        assert local.depths()['out'] == len(submission_ids)
+    assert all(0 < count <= 3 for count in held.values()), f'expected both workers to lease a few jobs each: {held}'
+    print('broker: ok')
+
+if __name__ == '__main__':
+    main()
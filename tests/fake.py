@@ -0,0 +1,230 @@
+"""Tests grading against the fake engine, which does not require matlab"""
+
+import json
+import os
+import datetime
+import time
+with open('conf/database.json', 'r') as infile:
+    SETTINGS = json.load(infile)
+
+if 'test' not in SETTINGS['file']:
+    raise RuntimeError(f'cannot run test against database without test in the name')
+
+for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(SETTINGS['file'] + suffix):
+        os.remove(SETTINGS['file'] + suffix)
+
+from main import load_logging
+from models import *
+from engines import FakeEngine, FakeScript
+from filecache import FileTreeCache
+from plans import load_plan
+import grader
+import migrations
+import reports
+import tempfile
+
+class CountingEngine(FakeEngine):
+    """A fake engine which counts how often it changes folder and remembers the folders"""
+    def __init__(self, workdir=None):
+        super().__init__(workdir)
+        self.cds = 0
+        self.paths = []
+
+    def cd(self, path):
+        self.cds += 1
+        self.paths.append(path)
+        return super().cd(path)
+
+class RecordingEngine(FakeEngine):
+    """A fake engine which records the variables in the workspace when each script starts"""
+    def __init__(self, workdir=None):
+        super().__init__(workdir)
+        self.seen = []
+
+    def run(self, name, stdout, stderr):
+        self.seen.append((name, set(self.workspace)))
+        return super().run(name, stdout, stderr)
+
+def main():
+    """Runs the test"""
+    migrations.migrate()
+    univ_wash = Institution.create(name='University of Washington')
+    sasha = Person.create(name='Aleksandr Aravkin')
+    timothy = Person.create(name='Timothy Moore')
+    amath352 = Group.create(institution=univ_wash, name='AMATH 352 Spring 2019', active=True)
+
+    assignment = Assignment.create(name='HW 1', group=amath352, creator=sasha, created_at=datetime.datetime.now(),
+                                   visible_at=datetime.datetime.now(), late_at=datetime.datetime.fromtimestamp(time.time() + 600),
+                                   late_penalty=0.2, closed_at=datetime.datetime.fromtimestamp(time.time() + 1200))
+    AssignmentProducedFile.create(assignment=assignment, filename='a1.mat')
+
+    p1_verfile = MatlabFile.create(name='problem1.m', contents='disp(\'checking a1\'); points = 4;')
+    p1 = Problem.create(assignment=assignment, points_out_of=5, verification_entry_file=p1_verfile)
+
+    p1_submfile = MatlabFile.create(name='problem1.m', contents='a1 = 3; save(\'a1.mat\')')
+    submission = Submission.create(assignment=assignment, submittor=timothy, submitted_at=datetime.datetime.now(),
+                                   submission_entry_file=p1_submfile)
+
+    engine = FakeEngine()
+    cache = FileTreeCache(tempfile.mkdtemp())
+    assert grader.grade(submission, engine, cache)
+    assert engine.ran == ['problem1', 'problem1'], engine.ran
+    subm_problem = SubmissionProblem.get(submission=submission, problem=p1)
+    assert subm_problem.points == 4, subm_problem.points
+    assert 'checking a1' in submission.report, submission.report
+    assert f'problem {p1.id}: ' in submission.report, submission.report
+
+    with tempfile.TemporaryDirectory() as workdir:
+        engine = CountingEngine(workdir)
+        assert grader.grade(submission, engine, cache, force=True)
+        assert engine.cds == 2, engine.cds
+        scratch = os.path.join(workdir, 'scratch')
+        assert sorted(os.listdir(scratch)) == ['submission', 'verification'], os.listdir(scratch)
+        assert not os.listdir(os.path.join(scratch, 'verification'))
+        assert grader.grade(submission, engine, cache, force=True)
+        assert len(set(engine.paths)) == 4, 'expected each submission to run in folders of its own'
+    assert len(os.listdir(cache.root)) == 2, os.listdir(cache.root)
+    p1_verfile.contents = 'points = 2;'
+    p1_verfile.save()
+    assert grader.grade(submission, FakeEngine(), cache)
+    assert SubmissionProblem.get(submission=submission, problem=p1).points == 2
+    assert len(os.listdir(cache.root)) == 3, os.listdir(cache.root)
+
+    hanging_file = MatlabFile.create(name='hw1.m', contents='while true; end')
+    hanging = Submission.create(assignment=assignment, submittor=timothy, submitted_at=datetime.datetime.now(),
+                                submission_entry_file=hanging_file)
+    grader.MAX_TIME = 0.3
+    starttime = time.time()
+    assert grader.grade(hanging, FakeEngine(scripts={'hw1': FakeScript(hang=True)}))
+    assert time.time() - starttime < 0.4, time.time() - starttime
+    assert 'cancelled due to timeout' in hanging.report, hanging.report
+    assert hanging.submission_problems.count() == 0
+
+    noisy_file = MatlabFile.create(name='noisy.m', contents='a1 = 3; save(\'a1.mat\')')
+    noisy = Submission.create(assignment=assignment, submittor=timothy, submitted_at=datetime.datetime.now(),
+                              submission_entry_file=noisy_file)
+    assert grader.grade(noisy, FakeEngine(scripts={'noisy': FakeScript(stdout='spam\n' * 2**20, files={'a1.mat': ''})}))
+    stored = SubmissionReport.get(SubmissionReport.submission == noisy)
+    assert stored.size <= reports.MAX_OUTPUT_BYTES + 4096, stored.size
+    assert len(stored.data) < stored.size // 10, len(stored.data)
+    assert 'bytes omitted' in noisy.report and 'Got 2.0/5.0' in noisy.report, noisy.report
+    listed = [subm for subm in Submission.select() if subm.id == noisy.id][0]
+    assert '_report' not in listed.__dict__
+    assert listed.report == noisy.report
+
+    missing_file = MatlabFile.create(name='hw1.m', contents='a1 = 3;')
+    missing = Submission.create(assignment=assignment, submittor=timothy, submitted_at=datetime.datetime.now(),
+                                submission_entry_file=missing_file)
+    assert grader.grade(missing, FakeEngine())
+    assert 'a1.mat' in missing.report, missing.report
+    setup_file = MatlabFile.create(name='setup.m', contents='expected = 3; save(\'expected.mat\')')
+    hw2 = Assignment.create(name='HW 2', group=amath352, creator=sasha, created_at=datetime.datetime.now(),
+                            visible_at=datetime.datetime.now(), late_at=datetime.datetime.fromtimestamp(time.time() + 600),
+                            late_penalty=0.2, closed_at=datetime.datetime.fromtimestamp(time.time() + 1200),
+                            assignment_verification_entry_file=setup_file)
+    Problem.create(assignment=hw2, points_out_of=1, verification_entry_file=MatlabFile.create(name='check.m', contents='points = 1;'))
+    engine = RecordingEngine()
+    for i in range(3):
+        hw2_subm = Submission.create(assignment=hw2, submittor=timothy, submitted_at=datetime.datetime.now(),
+                                     submission_entry_file=MatlabFile.create(name='hw2.m', contents=f'x = {i};'))
+        assert grader.grade(hw2_subm, engine, cache, warm_setup=True)
+        assert 'expected' in engine.workspace and 'x' in engine.workspace, engine.workspace
+        assert hw2_subm.submission_problems.get().points == 1
+    assert engine.ran.count('setup') == 1, engine.ran
+    assert engine.seen[:2] == [('setup', set()), ('hw2', set())], 'expected the setup to leave no variables behind'
+
+    setup_file.contents = 'expected = 4;'
+    setup_file.save()
+    assert grader.grade(hw2_subm, engine, cache, warm_setup=True)
+    assert engine.ran.count('setup') == 2, engine.ran
+    assert engine.workspace['expected'] == 4, engine.workspace
+
+    other = Assignment.create(name='HW 2b', group=amath352, creator=sasha, created_at=datetime.datetime.now(),
+                              visible_at=datetime.datetime.now(), late_at=datetime.datetime.fromtimestamp(time.time() + 600),
+                              late_penalty=0.2, closed_at=datetime.datetime.fromtimestamp(time.time() + 1200),
+                              assignment_verification_entry_file=MatlabFile.create(name='setup.m', contents='expected = 5;'))
+    Problem.create(assignment=other, points_out_of=1, verification_entry_file=MatlabFile.create(name='check.m', contents='points = 1;'))
+    other_subm = Submission.create(assignment=other, submittor=timothy, submitted_at=datetime.datetime.now(),
+                                   submission_entry_file=MatlabFile.create(name='hw2.m', contents='x = 5;'))
+    grader.MAX_WARM_SETUPS = 1
+    assert grader.grade(other_subm, engine, cache, warm_setup=True)
+    assert grader.grade(hw2_subm, engine, cache, warm_setup=True, force=True)
+    assert engine.ran.count('setup') == 4, 'expected the least recently used setup to be evicted'
+    root = grader._scratch(engine).root # pylint: disable=protected-access
+    assert len([name for name in os.listdir(root) if name.startswith('setup-')]) == 1, os.listdir(root)
+    grader.MAX_WARM_SETUPS = 4
+
+    resubmission = Submission.create(assignment=hw2, submittor=timothy, submitted_at=datetime.datetime.now(),
+                                     submission_entry_file=MatlabFile.create(name='hw2.m', contents='x = 2;'))
+    engine = FakeEngine()
+    assert grader.grade(resubmission, engine, cache)
+    assert engine.ran == [], engine.ran
+    assert f'identical to submission id={hw2_subm.id}' in resubmission.report, resubmission.report
+    assert resubmission.submission_problems.get().points == 1
+    assert grader.grade(hw2_subm, engine, cache)
+    assert engine.ran == [], engine.ran
+    assert grader.grade(resubmission, engine, cache, force=True)
+    assert engine.ran == ['hw2', 'setup', 'check'], engine.ran
+
+    hw3 = Assignment.create(name='HW 3', group=amath352, creator=sasha, created_at=datetime.datetime.now(),
+                            visible_at=datetime.datetime.now(), late_at=datetime.datetime.fromtimestamp(time.time() + 600),
+                            late_penalty=0.2, closed_at=datetime.datetime.fromtimestamp(time.time() + 1200))
+    checks = ['disp(\'first\'); y = 5; points = 1;', 'points = 2;', 'pause(0.2); points = 3;']
+    hw3_problems = [Problem.create(assignment=hw3, points_out_of=3, verification_entry_file=MatlabFile.create(
+        name=f'check{i}.m', contents=contents)) for i, contents in enumerate(checks)]
+    ProblemAuxilaryVerificationFiles.create(problem=hw3_problems[1], auxfile=MatlabFile.create(name='helper.m', contents='z = 1;'))
+    hw3_subm = Submission.create(assignment=hw3, submittor=timothy, submitted_at=datetime.datetime.now(),
+                                 submission_entry_file=MatlabFile.create(name='hw3.m', contents='x = 3;'))
+    engine = FakeEngine()
+    assert grader.grade(hw3_subm, engine, cache, batch_verification=True)
+    assert 'in one batch' in hw3_subm.report and 'first' in hw3_subm.report, hw3_subm.report
+    assert 'Grading finished successfully' in hw3_subm.report, hw3_subm.report
+    assert sorted(sp.points for sp in hw3_subm.submission_problems) == [1, 2, 3]
+    assert 'y' not in engine.workspace, engine.workspace
+
+    grader.MAX_TIME = 0.1
+    assert grader.grade(hw3_subm, FakeEngine(), cache, batch_verification=True, force=True)
+    assert 'one at a time' in hw3_subm.report, hw3_subm.report
+    assert 'cancelled due to timeout' in hw3_subm.report, hw3_subm.report
+    grader.MAX_TIME = 0.25
+    hw3_problems[1].verification_entry_file.contents = 'pause(0.1); points = 2;'
+    hw3_problems[1].verification_entry_file.save()
+    assert grader.grade(hw3_subm, FakeEngine(), cache, batch_verification=True, force=True)
+    assert 'one at a time' in hw3_subm.report and 'timeout' not in hw3_subm.report, hw3_subm.report
+    assert sorted(sp.points for sp in hw3_subm.submission_problems) == [1, 2, 3]
+    hw3_problems[1].verification_entry_file.contents = 'clear all; points = 2;'
+    hw3_problems[1].verification_entry_file.save()
+    grader.MAX_TIME = 0.3
+    assert grader.grade(hw3_subm, FakeEngine(), cache, batch_verification=True, force=True)
+    assert 'in one batch' in hw3_subm.report and 'one at a time' not in hw3_subm.report, hw3_subm.report
+    assert sorted(sp.points for sp in hw3_subm.submission_problems) == [1, 2, 3]
+    hw3_problems[1].verification_entry_file.contents = 'points = 2;'
+    hw3_problems[1].verification_entry_file.save()
+
+    ProblemAuxilaryVerificationFiles.create(problem=hw3_problems[2], auxfile=MatlabFile.create(name='helper.m', contents='z = 2;'))
+    assert grader.grade(hw3_subm, FakeEngine(), cache, batch_verification=True, force=True)
+    assert 'in one batch' not in hw3_subm.report, hw3_subm.report
+    assert sorted(sp.points for sp in hw3_subm.submission_problems) == [1, 2, 3]
+
+    twice = Submission.create(assignment=hw3, submittor=timothy, submitted_at=datetime.datetime.now(),
+                              submission_entry_file=MatlabFile.create(name='hw3.m', contents='x = 4;'))
+    first, second = load_plan(twice.id), load_plan(twice.id)
+    assert grader.grade(twice, FakeEngine(), cache, plan=first, force=True)
+    assert grader.grade(twice, FakeEngine(), cache, plan=second, force=True)
+    assert sorted(sp.points for sp in twice.submission_problems) == [1, 2, 3], 'expected the second grader to update the results'
+
+    hw3_problems[2].verification_entry_file.contents = 'error(\'broken\')'
+    hw3_problems[2].verification_entry_file.save()
+    ProblemAuxilaryVerificationFiles.delete().where(ProblemAuxilaryVerificationFiles.problem == hw3_problems[2]).execute()
+    try:
+        grader.grade(hw3_subm, FakeEngine(), cache, batch_verification=True, force=True)
+        raise AssertionError('expected the broken verification script to fail grading')
+    except grader.VerificationError as exc:
+        assert 'broken' in str(exc), exc
+    cache.close()
+    print('fake: ok')
+
+if __name__ == '__main__':
+    load_logging('conf/logging.json')
+    main()
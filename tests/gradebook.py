@@ -0,0 +1,114 @@
+"""Tests that grades are taken from the best or latest submission made before an assignment closed,
+with late penalties applied, and exported as csv and json. Does not require matlab"""
+
+import csv
+import datetime
+import io
+import json
+import os
+import time
+with open('conf/database.json', 'r') as infile:
+    SETTINGS = json.load(infile)
+
+if 'test' not in SETTINGS['file']:
+    raise RuntimeError(f'cannot run test against database without test in the name')
+
+for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(SETTINGS['file'] + suffix):
+        os.remove(SETTINGS['file'] + suffix)
+
+from models import *
+import gradebook
+
+START = datetime.datetime(2019, 4, 1)
+
+def _submission(assignment, person, days, points, graded=True):
+    """Creates a submission made the given number of days after START which got the given points on each problem"""
+    entry_file = MatlabFile.create(name='hw.m', contents=f'x = {days};')
+    submission = Submission.create(assignment=assignment, submittor=person, submitted_at=START + datetime.timedelta(days=days),
+                                   submission_entry_file=entry_file, graded_at=time.time() if graded else None)
+    for problem, problem_points in zip(assignment.problems.order_by(Problem.id), points):
+        SubmissionProblem.create(submission=submission, problem=problem, points_out_of=problem.points_out_of, points=problem_points)
+    return submission
+
+def main():
+    """Runs the test"""
+    univ_wash = Institution.create(name='University of Washington')
+    sasha = Person.create(name='Aleksandr Aravkin')
+    timothy, alice, bob = [Person.create(name=name) for name in ('Timothy Moore', 'Alice', 'Bob')]
+    amath352 = Group.create(institution=univ_wash, name='AMATH 352 Spring 2019', active=True)
+    other = Group.create(institution=univ_wash, name='AMATH 301 Spring 2019', active=True)
+    PersonGroup.create(person=sasha, group=amath352, leader=True)
+    for person in (timothy, alice, bob):
+        PersonGroup.create(person=person, group=amath352, leader=False)
+
+    hw1, hw2 = [Assignment.create(name=name, group=amath352, creator=sasha, created_at=START, visible_at=START,
+                                  late_at=START + datetime.timedelta(days=7), late_penalty=0.5,
+                                  closed_at=START + datetime.timedelta(days=14))
+                for name in ('HW 1', 'HW 2')]
+    verfile = MatlabFile.create(name='check.m', contents='points = 1;')
+    for assignment in (hw1, hw2):
+        for points_out_of in (4, 6):
+            Problem.create(assignment=assignment, points_out_of=points_out_of, verification_entry_file=verfile)
+    Assignment.create(name='HW 1', group=other, creator=sasha, created_at=START, visible_at=START,
+                      late_at=START, late_penalty=0, closed_at=START)
+
+    best = _submission(hw1, timothy, 1, [4, 4])
+    _submission(hw1, timothy, 2, [2, 1])
+    late = _submission(hw1, alice, 9, [4, 6])
+    ontime = _submission(hw1, alice, 3, [4, 2])
+    _submission(hw1, alice, 15, [4, 6])
+    _submission(hw1, bob, 2, [4, 6], graded=False)
+    partial = _submission(hw2, bob, 1, [3])
+    stranger = Person.create(name='Auditor')
+    _submission(hw2, stranger, 1, [1, 1])
+
+    rows = {(grade.person_id, grade.assignment_id): grade for grade in gradebook.grades([amath352.id])}
+    assert len(rows) == 8, rows
+    grade = rows[(timothy.id, hw1.id)]
+    assert grade.submission_id == best.id and grade.points == 8 and grade.submissions == 2 and grade.points_out_of == 10
+    grade = rows[(alice.id, hw1.id)]
+    assert grade.submission_id == ontime.id and grade.points == 6 and grade.penalty == 0, 'expected 6 on time to beat 10 late'
+    assert grade.submissions == 2, 'expected the submission after the assignment closed not to count'
+    grade = rows[(bob.id, hw1.id)]
+    assert grade.submission_id is None and grade.points is None and grade.submissions == 0, grade
+    assert rows[(bob.id, hw2.id)].submission_id == partial.id and rows[(bob.id, hw2.id)].points == 3
+    assert rows[(stranger.id, hw2.id)].points == 2 and rows[(stranger.id, hw1.id)].points is None
+    assert sasha.id not in {person_id for person_id, _ in rows}
+
+    latest = {(grade.person_id, grade.assignment_id): grade for grade in gradebook.grades(policy='latest')}
+    assert latest[(timothy.id, hw1.id)].points == 3
+    grade = latest[(alice.id, hw1.id)]
+    assert grade.submission_id == late.id and grade.raw_points == 10 and grade.penalty == 0.5 and grade.points == 5, grade
+    assert list(gradebook.grades(assignments=[hw2.id], policy='latest'))[0].assignment_id == hw2.id
+    assert list(gradebook.grades(groups=[])) == []
+    assert list(gradebook.grades([other.id])) == []
+    try:
+        list(gradebook.grades(policy='worst'))
+        assert False, 'expected an unknown policy to be rejected'
+    except ValueError:
+        pass
+
+    outfile = io.StringIO()
+    gradebook.write_csv(outfile, gradebook.grades([amath352.id]))
+    lines = list(csv.DictReader(io.StringIO(outfile.getvalue())))
+    assert len(lines) == 8 and lines[0]['person'] == 'Timothy Moore' and lines[0]['points'] == '8.0', lines[0]
+
+    outfile = io.StringIO()
+    gradebook.write_wide_csv(outfile, gradebook.grades([amath352.id]))
+    lines = list(csv.reader(io.StringIO(outfile.getvalue())))
+    assert lines[0] == ['group', 'person_id', 'person', 'HW 1', 'HW 2', 'total'], lines[0]
+    assert lines[1] == ['AMATH 352 Spring 2019', str(timothy.id), 'Timothy Moore', '8.0', '', '8.0'], lines[1]
+    assert len(lines) == 5
+
+    outfile = io.StringIO()
+    gradebook.write_json(outfile, gradebook.grades([amath352.id]))
+    loaded = json.loads(outfile.getvalue())
+    assert len(loaded) == 8 and loaded[0]['submission_id'] == best.id
+    outfile = io.StringIO()
+    gradebook.write_json(outfile, iter([]))
+    assert json.loads(outfile.getvalue()) == []
+    print('gradebook: ok')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Tests the batched job queue, including noticing jobs pushed from another process"""
+
+import subprocess
+import sys
+import tempfile
+import time
+
+from jobqueue import BatchAckQueue
+
+def main():
+    """Runs the test"""
+    with tempfile.TemporaryDirectory() as folder:
+        que = BatchAckQueue(folder)
+        assert que.get_batch(5, timeout=0) == []
+
+        que.put_batch([1, 2, 3])
+        jobs = que.get_batch(2, timeout=0)
+        assert [job['data'] for job in jobs] == [1, 2], jobs
+        assert que.size == 1
+
+        que.nack_batch([jobs[1]['pqid']])
+        que.ack_batch([jobs[0]['pqid']])
+        jobs = que.get_batch(5, timeout=0)
+        assert sorted(job['data'] for job in jobs) == [2, 3], jobs
+        que.ack_batch([job['pqid'] for job in jobs])
+        assert que.acked_count() == 3
+
+        starttime = time.time()
+        assert que.get_batch(5, timeout=0.2) == []
+        assert 0.2 <= time.time() - starttime < 0.3
+
+        pusher = subprocess.Popen([sys.executable, '-c', (
+            'import sys, time, persistqueue; time.sleep(0.3); '
+            f'persistqueue.SQLiteAckQueue({folder!r}).put(4); print(time.time())')],
+                                  stdout=subprocess.PIPE, text=True)
+        jobs = que.get_batch(5, timeout=5)
+        woke_at = time.time()
+        pushed_at = float(pusher.communicate()[0])
+        assert [job['data'] for job in jobs] == [4], jobs
+        assert woke_at - pushed_at < 0.1, woke_at - pushed_at
+    print('jobqueue: ok')
+
+if __name__ == '__main__':
+    main()
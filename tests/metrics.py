@@ -0,0 +1,54 @@
+"""Tests that metrics are rendered in the Prometheus text format, served and dumped. Does not
+require matlab"""
+
+import os
+import tempfile
+import urllib.request
+
+import metrics
+
+def main():
+    """Runs the test"""
+    jobs = metrics.Counter('test_jobs', 'Jobs by result', ('result',))
+    depth = metrics.Gauge('test_depth', 'Waiting jobs')
+    latency = metrics.Histogram('test_latency_seconds', 'Latency "quoted"', ('phase',), buckets=(0.1, 1))
+
+    jobs.inc(result='done')
+    jobs.inc(2, result='done')
+    depth.set(5)
+    depth.inc(-1)
+    for value in (0.05, 0.5, 5):
+        latency.observe(value, phase='run')
+    try:
+        jobs.inc(outcome='done')
+        raise AssertionError('expected the wrong label to be rejected')
+    except ValueError:
+        pass
+
+    text = metrics.render()
+    assert 'test_jobs_total{result="done"} 3.0' in text, text
+    assert 'test_depth 4.0' in text, text
+    assert 'test_latency_seconds_bucket{phase="run",le="0.1"} 1' in text, text
+    assert 'test_latency_seconds_bucket{phase="run",le="1.0"} 2' in text, text
+    assert 'test_latency_seconds_bucket{phase="run",le="+Inf"} 3' in text, text
+    assert 'test_latency_seconds_count{phase="run"} 3' in text, text
+    assert '# HELP test_latency_seconds Latency \\"quoted\\"' in text, text
+    assert latency.count(phase='run') == 3
+
+    server = metrics.serve(0)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            assert response.read().decode('utf-8') == metrics.render()
+    finally:
+        server.shutdown()
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'evaluator.prom')
+        dumper = metrics.FileDumper(path, interval=60)
+        dumper.stop()
+        with open(path, 'r') as infile:
+            assert infile.read() == metrics.render()
+    print('metrics: ok')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Tests that databases from older versions of this program are upgraded. Does not require matlab"""
+
+import json
+import os
+import sqlite3
+with open('conf/database.json', 'r') as infile:
+    SETTINGS = json.load(infile)
+
+if 'test' not in SETTINGS['file']:
+    raise RuntimeError(f'cannot run test against database without test in the name')
+
+for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(SETTINGS['file'] + suffix):
+        os.remove(SETTINGS['file'] + suffix)
+
+LEGACY_SCHEMA = '''
+CREATE TABLE "institution" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL);
+CREATE TABLE "group" ("id" INTEGER NOT NULL PRIMARY KEY, "institution_id" INTEGER NOT NULL, "name" VARCHAR(255) NOT NULL, "active" INTEGER NOT NULL, FOREIGN KEY ("institution_id") REFERENCES "institution" ("id"));
+CREATE INDEX "group_institution_id" ON "group" ("institution_id");
+CREATE TABLE "person" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL);
+CREATE TABLE "matlabfile" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "contents" TEXT NOT NULL);
+CREATE TABLE "assignment" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "group_id" INTEGER NOT NULL, "creator_id" INTEGER NOT NULL, "created_at" DATETIME NOT NULL, "visible_at" DATETIME NOT NULL, "late_at" DATETIME NOT NULL, "late_penalty" REAL NOT NULL, "closed_at" DATETIME NOT NULL, "assignment_verification_entry_file_id" INTEGER, FOREIGN KEY ("group_id") REFERENCES "group" ("id"), FOREIGN KEY ("creator_id") REFERENCES "person" ("id"), FOREIGN KEY ("assignment_verification_entry_file_id") REFERENCES "matlabfile" ("id"));
+CREATE INDEX "assignment_group_id" ON "assignment" ("group_id");
+CREATE TABLE "problem" ("id" INTEGER NOT NULL PRIMARY KEY, "assignment_id" INTEGER NOT NULL, "points_out_of" REAL NOT NULL, "verification_entry_file_id" INTEGER NOT NULL, FOREIGN KEY ("assignment_id") REFERENCES "assignment" ("id"), FOREIGN KEY ("verification_entry_file_id") REFERENCES "matlabfile" ("id"));
+CREATE INDEX "problem_assignment_id" ON "problem" ("assignment_id");
+CREATE TABLE "submission" ("id" INTEGER NOT NULL PRIMARY KEY, "assignment_id" INTEGER NOT NULL, "submittor_id" INTEGER NOT NULL, "submitted_at" DATETIME NOT NULL, "graded_at" DATETIME, "report" TEXT, "submission_entry_file_id" INTEGER NOT NULL, FOREIGN KEY ("assignment_id") REFERENCES "assignment" ("id"), FOREIGN KEY ("submittor_id") REFERENCES "person" ("id"), FOREIGN KEY ("submission_entry_file_id") REFERENCES "matlabfile" ("id"));
+CREATE INDEX "submission_assignment_id" ON "submission" ("assignment_id");
+CREATE TABLE "submissionproblem" ("id" INTEGER NOT NULL PRIMARY KEY, "submission_id" INTEGER NOT NULL, "problem_id" INTEGER NOT NULL, "points_out_of" REAL NOT NULL, "points" REAL, FOREIGN KEY ("submission_id") REFERENCES "submission" ("id"), FOREIGN KEY ("problem_id") REFERENCES "problem" ("id"));
+CREATE INDEX "submissionproblem_submission_id" ON "submissionproblem" ("submission_id");
+INSERT INTO institution (id, name) VALUES (1, 'University of Washington');
+INSERT INTO person (id, name) VALUES (1, 'Aleksandr Aravkin');
+INSERT INTO "group" (id, institution_id, name, active) VALUES (1, 1, 'AMATH 352 Spring 2019', 1);
+INSERT INTO matlabfile (id, name, contents) VALUES (1, 'hw1.m', 'x = 1;'), (2, 'helper.m', 'y = 2;'), (3, 'helper.m', 'y = 2;');
+INSERT INTO assignment (id, name, group_id, creator_id, created_at, visible_at, late_at, late_penalty, closed_at)
+    VALUES (1, 'HW 1', 1, 1, '2019-04-01 00:00:00', '2019-04-01 00:00:00', '2019-04-08 00:00:00', 0.2, '2019-04-15 00:00:00');
+INSERT INTO problem (id, assignment_id, points_out_of, verification_entry_file_id) VALUES (1, 1, 1, 1);
+INSERT INTO submission (id, assignment_id, submittor_id, submitted_at, graded_at, report, submission_entry_file_id)
+    VALUES (1, 1, 1, '2019-04-02 00:00:00', '2019-04-02 00:01:00', 'old report', 1), (2, 1, 1, '2019-04-03 00:00:00', NULL, NULL, 1);
+INSERT INTO submissionproblem (id, submission_id, problem_id, points_out_of, points) VALUES (1, 1, 1, 1, 1), (2, 1, 1, 1, 0);
+'''
+"""The tables the first version of this program created, with a few rows, written before models.py
+is imported since importing it creates the tables and indexes of the current version"""
+
+with sqlite3.connect(SETTINGS['file']) as legacy:
+    legacy.executescript(LEGACY_SCHEMA)
+    # left behind by versions which created the blob index when importing models.py
+    legacy.execute('CREATE INDEX "matlabfile_blob_id" ON "matlabfile" ("blob_id")')
+legacy.close()
+
+from models import *
+import migrations
+
+def main():
+    """Runs the test"""
+    assert migrations.migrate() == len(migrations.MIGRATIONS)
+    assert 'report' not in [column.name for column in DATABASE.get_columns('submission')]
+    assert Submission.get_by_id(1).report == 'old report'
+    assert Submission.get_by_id(2).report is None
+    assert 'contents' not in [column.name for column in DATABASE.get_columns('matlabfile')]
+    assert 'matlabfile_blob_id' in [index.name for index in DATABASE.get_indexes('matlabfile')]
+    assert FileBlob.select().count() == 2
+    helpers = [MatlabFile.get_by_id(helper_id) for helper_id in (2, 3)]
+    assert helpers[0].blob_id == helpers[1].blob_id and helpers[0].contents == 'y = 2;'
+    graded = Submission.get_by_id(1)
+    assert graded.submission_entry_file.contents == 'x = 1;'
+    assert [subm_problem.id for subm_problem in graded.submission_problems] == [1]
+    try:
+        SubmissionProblem.create(submission=graded, problem=1, points_out_of=1, points=0)
+        raise AssertionError('expected a duplicate result to be rejected')
+    except IntegrityError:
+        pass
+    assert DATABASE.pragma('journal_mode') == 'wal'
+    assert migrations.migrate() == 0
+
+    print('migrations: ok')
+
+if __name__ == '__main__':
+    main()
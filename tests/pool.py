@@ -0,0 +1,60 @@
+"""Tests that the engine pool grades concurrently, giving each call its own engine. Does not
+require matlab"""
+
+import os
+import threading
+import time
+
+from engines import Engine
+from pool import EnginePool
+
+class StandInEngine(Engine):
+    """An engine which does not run anything, used to check which engine a call received"""
+    def __init__(self, workdir=None):
+        super().__init__(workdir)
+        self.in_use = threading.Lock()
+        self.calls = 0
+
+    def cd(self, path):
+        return self.workdir
+
+    def quit(self):
+        self.workdir = None
+
+def _use(engine, duration):
+    if not engine.in_use.acquire(blocking=False):
+        raise AssertionError('engine given to two calls at once')
+    try:
+        engine.calls += 1
+        time.sleep(duration)
+        return engine
+    finally:
+        engine.in_use.release()
+
+def main():
+    """Runs the test"""
+    with EnginePool(4, StandInEngine) as pool:
+        workdirs = [engine.workdir for engine in pool.engines]
+        assert len(set(workdirs)) == 4, workdirs
+        assert all(os.path.isdir(workdir) for workdir in workdirs), workdirs
+
+        starttime = time.time()
+        futures = [pool.submit(_use, 0.2) for _ in range(8)]
+        used = [future.result() for future in futures]
+        elapsed = time.time() - starttime
+        assert elapsed < 0.6, f'expected 8 jobs of 0.2s on 4 engines to take ~0.4s but took {elapsed}'
+        assert set(used) == set(pool.engines)
+        assert sum(engine.calls for engine in pool.engines) == 8
+
+        first = pool.submit(_use, 0, affinity='hw1').result()
+        pool.submit(_use, 0, affinity='hw2').result()
+        assert pool.idle_affinities() == {'hw1', 'hw2'}, pool.idle_affinities()
+        assert all(pool.submit(_use, 0, affinity='hw1').result() is first for _ in range(3))
+        rootdir = pool.rootdir
+
+    assert not os.path.exists(rootdir)
+    assert all(engine.workdir is None for engine in used)
+    print('pool: ok')
+
+if __name__ == '__main__':
+    main()
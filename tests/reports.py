@@ -0,0 +1,36 @@
+"""Tests that grading reports are kept to a bounded size. Does not require matlab"""
+
+from reports import BoundedReport
+
+def main():
+    """Runs the test"""
+    report = BoundedReport(100)
+    print('short', file=report)
+    assert report.getvalue() == 'short\n' and report.omitted == 0
+
+    for i in range(10000):
+        print(f'line {i}', file=report)
+    value = report.getvalue()
+    assert value.startswith('short\nline 0\n'), value
+    assert value.endswith('line 9999\n'), value
+    assert f'{report.omitted} bytes omitted' in value, value
+    assert report.written == len(value.encode('utf-8')) - len(f'\n... {report.omitted} bytes omitted ...\n') + report.omitted
+
+    report = BoundedReport(10)
+    report.write('é' * 100)
+    assert report.written == 200 and report.omitted == 190
+    value = report.getvalue()
+    assert value == 'éé\n... 192 bytes omitted ...\néé', value
+
+    report = BoundedReport(10)
+    for text in ('abcd', 'é', 'xy'):
+        report.write(text)
+    assert report.omitted == 0 and report.getvalue() == 'abcdéxy', report.getvalue()
+    report = BoundedReport(9)
+    report.write('abcdé€xyz')
+    value = report.getvalue()
+    assert value == 'abcd\n... 5 bytes omitted ...\nxyz', value
+    print('reports: ok')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Tests that queued jobs are handed out by priority then assignment, and that duplicates are
+coalesced. Does not require matlab"""
+
+import datetime
+import json
+import os
+import tempfile
+import time
+with open('conf/database.json', 'r') as infile:
+    SETTINGS = json.load(infile)
+
+if 'test' not in SETTINGS['file']:
+    raise RuntimeError(f'cannot run test against database without test in the name')
+
+for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(SETTINGS['file'] + suffix):
+        os.remove(SETTINGS['file'] + suffix)
+
+from models import *
+from jobqueue import BatchAckQueue
+from scheduler import Scheduler
+import main as evaluator
+
+def _submission(assignment, person, graded):
+    entry_file = MatlabFile.create(name='hw.m', contents='x = 1;')
+    return Submission.create(assignment=assignment, submittor=person, submitted_at=datetime.datetime.now(),
+                             submission_entry_file=entry_file, graded_at=time.time() if graded else None)
+
+def main():
+    """Runs the test"""
+    univ_wash = Institution.create(name='University of Washington')
+    sasha = Person.create(name='Aleksandr Aravkin')
+    timothy = Person.create(name='Timothy Moore')
+    amath352 = Group.create(institution=univ_wash, name='AMATH 352 Spring 2019', active=True)
+    hw1, hw2 = [Assignment.create(name=name, group=amath352, creator=sasha, created_at=datetime.datetime.now(),
+                                  visible_at=datetime.datetime.now(), late_at=datetime.datetime.now(),
+                                  late_penalty=0.2, closed_at=datetime.datetime.now())
+                for name in ('HW 1', 'HW 2')]
+
+    regrade1, regrade2 = _submission(hw1, timothy, True), _submission(hw2, timothy, True)
+    fresh1, fresh2 = _submission(hw1, timothy, False), _submission(hw2, timothy, False)
+
+    with tempfile.TemporaryDirectory() as folder:
+        que = BatchAckQueue(folder)
+        que.put_batch([regrade1.id, regrade2.id, fresh2.id, regrade1.id, fresh1.id, 'bad',
+                       {'submission': regrade2.id, 'priority': 100}])
+        scheduler = Scheduler(que, lookahead=5)
+        assert scheduler.fill() == 6, 'expected the duplicate to leave room for another job'
+        assert scheduler.fill() == 0
+        assert len(scheduler.buffered) == 5
+
+        job = scheduler.take()
+        assert job.submission_id == fresh2.id, job.data
+        assert scheduler.take({hw1.id}).submission_id == fresh1.id
+        assert scheduler.take().data == 'bad'
+        job = scheduler.take({hw2.id})
+        assert job.submission_id == regrade2.id and job.assignment_id == hw2.id
+        regrade = scheduler.take({hw2.id})
+        assert regrade.submission_id == regrade1.id
+        assert len(regrade.items) == 2, regrade.items
+        assert scheduler.take() is None
+
+        assert scheduler.fill() == 1
+        assert scheduler.take() is None, 'expected a submission being graded not to be handed out again'
+        scheduler.finished(job)
+        job = scheduler.take()
+        assert job.submission_id == regrade2.id and job.priority == 100
+        assert scheduler.drain() == []
+
+    regrades = [_submission(hw1, timothy, True).id for _ in range(20)]
+    for workers in ('1', '2'):
+        fresh = _submission(hw1, timothy, False).id
+        with tempfile.TemporaryDirectory() as folder:
+            BatchAckQueue(os.path.join(folder, 'in')).put_batch(regrades + [fresh])
+            evaluator.main(['--input-database', os.path.join(folder, 'in'), '--output-database', os.path.join(folder, 'out'),
+                            '--engine', 'fake', '--workers', workers, '--logging-conf', 'conf/logging.json'])
+            order = [item['data'] for item in BatchAckQueue(os.path.join(folder, 'out')).get_batch(100, timeout=0)]
+        assert sorted(order) == sorted(regrades + [fresh])
+        assert fresh in order[:int(workers)], f'expected the new submission to be graded before the regrades queued earlier: {order}'
+    print('scheduler: ok')
+
+if __name__ == '__main__':
+    main()
@@ -11,15 +11,18 @@ with open('conf/database.json', 'r') as infile:
 if 'test' not in SETTINGS['file']:
     raise RuntimeError(f'cannot run test against database without test in the name')
 
-if os.path.exists(SETTINGS['file']):
-    os.remove(SETTINGS['file'])
+for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(SETTINGS['file'] + suffix):
+        os.remove(SETTINGS['file'] + suffix)
 
 from main import load_logging
 from models import *
 import grader
+import migrations
 
 def main():
     """Runs the test"""
+    migrations.migrate()
 
     univ_wash = Institution.create(name='University of Washington')
     sasha = Person.create(name='Aleksandr Aravkin')
@@ -0,0 +1,81 @@
+"""Tests that engines in child processes are killed when stuck and recycled when leaking, using
+the fake engine so that matlab is not required"""
+
+import functools
+import io
+import os
+import tempfile
+import time
+
+from engines import FakeEngine, FakeScript
+from pool import EnginePool
+from supervisor import EngineCrashedError, ProcessEngine
+
+SCRIPTS = {
+    'stuck': FakeScript(hang=True, ignore_cancel=True),
+    'leaky': FakeScript(leak=64 * 2**20),
+}
+
+def _write_scripts(folder):
+    for name, contents in (('stuck', 'mex_call()'), ('leaky', 'x = 1;'), ('ok', 'points = 3;')):
+        with open(os.path.join(folder, f'{name}.m'), 'w') as outfile:
+            outfile.write(contents)
+
+def _run(engine, name):
+    engine.cd(engine.workdir)
+    future = engine.run(name, io.StringIO(), io.StringIO())
+    if not future.wait(0.2):
+        future.cancel()
+    return future
+
+def main():
+    """Runs the test"""
+    with tempfile.TemporaryDirectory() as folder:
+        _write_scripts(folder)
+        engine = ProcessEngine(functools.partial(FakeEngine, scripts=SCRIPTS), workdir=folder, kill_after=0.3)
+        engine.start()
+        pid = engine.process.pid
+
+        starttime = time.time()
+        assert _run(engine, 'stuck').cancelled()
+        assert time.time() - starttime < 1.5, time.time() - starttime
+        assert engine.process is None
+
+        assert not _run(engine, 'ok').cancelled()
+        assert engine.get_variable('points') == 3
+        results = engine.run_batch(['leaky', 'ok'], 'points', io.StringIO(), io.StringIO()).result(5)
+        assert [result.value for result in results] == [3, 3], [result.value for result in results]
+        assert engine.process.pid != pid
+
+        engine.process.kill()
+        engine.process.join()
+        try:
+            engine.cd(folder)
+            raise AssertionError('expected the crash to be noticed')
+        except EngineCrashedError:
+            pass
+        assert engine.cd(folder) is not None
+        engine.quit()
+
+        factory = functools.partial(ProcessEngine, functools.partial(FakeEngine, scripts=SCRIPTS))
+        with EnginePool(1, factory, rootdir=folder, max_memory=32 * 2**20) as pool:
+            engine = pool.engines[0]
+            _write_scripts(engine.workdir)
+            pid = engine.process.pid
+            pool.submit(_run, 'ok').result()
+            assert engine.process.pid == pid
+            pool.submit(_run, 'leaky').result()
+            assert engine.process.pid != pid
+
+        with EnginePool(1, factory, rootdir=folder, max_jobs=2) as pool:
+            engine = pool.engines[0]
+            _write_scripts(engine.workdir)
+            pid = engine.process.pid
+            pool.submit(_run, 'ok').result()
+            assert engine.process.pid == pid
+            pool.submit(_run, 'ok').result()
+            assert engine.process.pid != pid
+    print('supervisor: ok')
+
+if __name__ == '__main__':
+    main()